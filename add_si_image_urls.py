@@ -1,58 +1,131 @@
 #!/usr/bin/env python
 
+"""
+Fill in the missing image urls in a csv file of Smithsonian metadata, looking them up in
+EDAN (see etl_si.get_image_urls()).
+
+The csv file needs the legacy column layout (as run.py used to output it), with the
+artwork's object number in a 'Resource Identifier' column and its image urls (separated
+by '|') in an 'Images' column. Note: run.py's current output (see OUTPUT_COLS in
+etl/tools.py) has no identifier column, so it can't be used as is.
+
+Usage: add_si_image_urls.py input_file output_file
+
+The urls found so far are saved in a checkpoint (etl/data/si/image_urls.json), so if the
+script is interrupted (or some lookups fail), running it again only looks up the rest.
+
+Note: the urls are looked up one at a time, since the Smithsonian's api key only allows
+1000 requests an hour (see HOST_CONFIG in etl/http_client.py), so looking them up
+concurrently wouldn't make it any faster.
+"""
+
 import csv
+import os
 import sys
 
-
 from etl.etl_si import get_image_urls
+from etl.tools import read_json, write_json_atomic
 
 
-fieldnames = [ 'Resource Identifier', 'Title', 'Author/Artist', 'Description', 'Date', 'ResourceType', 'Digital Format', 'Dimensions', 'URL', 'Source', 'Language', 'Subjects (Historic Era)', 'Subjects (Topic/Keywords)', 'Subjects (Geographic)', 'Notes', 'Copyright Status', 'Collection Information', 'Credit Line', 'Images' ]
+CHECKPOINT_PATH = "etl/data/si/image_urls.json"
 
+# The checkpoint is saved after this many lookups (and when the script finishes).
+CHECKPOINT_INTERVAL = 25
 
-if __name__ == "__main__":
+ID_FIELD = 'Resource Identifier'
+IMAGES_FIELD = 'Images'
+
+
+def lookup_image_urls(id_):
+    "Returns the image urls for the given id, or None if they couldn't be looked up."
+
+    try:
+
+        return get_image_urls(id_=id_)
+
+    except Exception as exc:
+
+        print(f"Error looking up image urls for {id_} ({exc})", file=sys.stderr)
+
+        return None
+
+def add_image_urls(input_file, output_file):
+    "Copy the input csv file to the output file, filling in missing image urls."
+
+    # id -> image urls
+    image_urls = read_json(file_path=CHECKPOINT_PATH, default={})
+
+    with open(input_file, "r", newline="") as input:
 
-    input_file = sys.argv[1]
-    first_row = int(sys.argv[2])
+        reader = csv.DictReader(input)
+        fieldnames = reader.fieldnames
+        rows = list(reader)
 
-    row_len = len(fieldnames)
+    if ID_FIELD not in fieldnames or IMAGES_FIELD not in fieldnames:
 
-    row_num = 0
-    batch_size = 250
+        raise Exception(f"{input_file} needs '{ID_FIELD}' and '{IMAGES_FIELD}' columns")
 
-    with open(input_file, 'r') as csvfile:
+    ids = { row[ID_FIELD] for row in rows if row[ID_FIELD] and not row[IMAGES_FIELD] and row[ID_FIELD] not in image_urls }
 
-        datareader = csv.reader(csvfile)
-        datawriter = csv.DictWriter(sys.stdout, fieldnames=fieldnames)
-        datawriter.writeheader()
+    print(f"Looking up image urls for {len(ids)} ids ({len(image_urls)} already looked up)", file=sys.stderr)
 
-        first_row = True
+    os.makedirs(os.path.dirname(CHECKPOINT_PATH), exist_ok=True)
 
-        for row in datareader:
+    # Ids that have been looked up (successfully or not) in this run.
+    looked_up = set()
+    num_failed = 0
 
-            if first_row:
+    try:
 
-                first_row = False
-                continue
+        with open(output_file, "w", newline="") as output:
 
-            id_ = row[0]
+            writer = csv.DictWriter(output, fieldnames=fieldnames)
+            writer.writeheader()
 
-            if not id_:
+            for row in rows:
 
-                pass
+                id_ = row[ID_FIELD]
 
-            if row_num >= first_row and row_num < (first_row + batch_size):
+                if id_ and not row[IMAGES_FIELD]:
 
-                urls = row[row_len - 1]
-                if not urls:
+                    if id_ in ids and id_ not in looked_up:
 
-                    urls = get_image_urls(id_=id_)
-                    if urls:
+                        looked_up.add(id_)
+
+                        urls = lookup_image_urls(id_=id_)
+                        if urls is None:
+
+                            num_failed += 1
+
+                        else:
+
+                            image_urls[id_] = urls
+
+                        if len(looked_up) % CHECKPOINT_INTERVAL == 0:
+
+                            write_json_atomic(file_path=CHECKPOINT_PATH, data=image_urls)
+
+                            print(f"Looked up image urls for {len(looked_up)} of {len(ids)} ids", file=sys.stderr)
+
+                    row[IMAGES_FIELD] = "|".join(image_urls.get(id_, []))
+
+                writer.writerow(row)
+                output.flush()
+
+    finally:
+
+        write_json_atomic(file_path=CHECKPOINT_PATH, data=image_urls)
+
+    if num_failed:
+
+        print(f"Couldn't look up image urls for {num_failed} ids - run the script again to retry them", file=sys.stderr)
+
+
+if __name__ == "__main__":
 
-                        urls = '|'.join(urls)
-                        row.append(urls)
+    if len(sys.argv) != 3:
 
-            row_data = { name : row[idx] for idx, name in enumerate(fieldnames) }
+        print("Usage: add_si_image_urls.py input_file output_file", file=sys.stderr)
+        sys.exit(1)
 
-            datawriter.writerow(row_data)
-            row_num += 1
+    add_image_urls(input_file=sys.argv[1], output_file=sys.argv[2])
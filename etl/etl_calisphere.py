@@ -1,10 +1,12 @@
 #!/usr/bin/env python
 
+from concurrent.futures import ThreadPoolExecutor
 import json
 import os
-import requests
 import sys
+from urllib.parse import quote
 
+from etl import http_client
 from etl.etl_process import BaseETLProcess
 from etl.setup import ETLEnv
 from etl.tools import RhizomeField, remove_author_job_desc
@@ -17,7 +19,8 @@ api_key = etl_env.get_api_key(name="calisphere")
 
 # Note: data pull instructions are here: https://docs.google.com/document/d/1m4mxCY_tbAOrPEwjrCsBKjsPT8NEcBFtgPsOzWezj3k/edit
 
-rows = 5000
+# Number of records to retrieve per page (see get_collection_hits()).
+rows = 1000
 
 SOLR_KEYS = [
     "title",
@@ -62,6 +65,19 @@ field_map = {
     "reference_image_md5":   RhizomeField.IMAGES,
 }
 
+# Fields that are searched for a collection's search terms by Solr (see get_term_query()).
+TERM_QUERY_FIELDS = [
+    "title",
+    "subject",
+    "creator",
+    "description",
+    "type",
+    "date",
+    "language",
+    "repository_name",
+    "rights_holder",
+]
+
 # REVIEW: Would be nice to put something in place to check that we get expected # of results back for each
 # collection (like the logic in the PTH data pull).
 
@@ -141,22 +157,196 @@ collections = [
 
 def get_overview(hit, keys):
 
-    overview = ''
+    values = []
 
     for key in keys:
 
         tmp = hit.get(key, [])
         if type(tmp) is str:
 
-            overview += ' ' + tmp
+            values.append(tmp)
 
         elif type(tmp) is list:
 
-            for val in tmp:
+            values += tmp
+
+    return ''.join(' ' + val for val in values).lower()
+
+def matches_terms(hit, terms):
+    "Returns True if the hit contains any of the search terms."
+
+    overview = get_overview(hit=hit, keys=SOLR_KEYS)
+
+    for term in terms:
+
+        if term in overview:
+
+            return True
+
+    return False
+
+def get_term_query(terms):
+    """
+    Returns a Solr query that matches records containing any of the search terms (in any
+    of the TERM_QUERY_FIELDS), so that Solr only sends us those records. Single words are
+    matched anywhere in a word (as in matches_terms()), and phrases as phrases.
+
+    Note: Solr's matching isn't exactly the same as matches_terms() (which is still used
+    to check each record): matches_terms() looks at more fields (SOLR_KEYS), and Solr's
+    wildcard matching is case-sensitive for string fields (e.g., type, language). So this
+    is only used with --filter_terms_in_solr=yes, and should be checked first with
+    --verify_term_filters=yes.
+    """
+
+    clauses = []
+
+    for term in terms:
+
+        if " " in term or "-" in term:
+
+            value = f'"{term}"'
+
+        else:
+
+            value = f"*{term}*"
+
+        clauses += [ f"{field}:{value}" for field in TERM_QUERY_FIELDS ]
+
+    return " OR ".join(clauses)
+
+def get_collection_hits(collection, terms=None):
+    """
+    Yields the Solr hits for the given collection, one page at a time, using Solr's
+    cursor based pagination (so large collections are retrieved in full, without having
+    to hold all their hits in memory at once). Reports if fewer hits were retrieved than
+    Solr says there are. If there are search terms, only the hits that Solr finds contain
+    them are retrieved (see get_term_query()).
+    """
+
+    headers = { "X-Authentication-Token": api_key }
+
+    # Note: cursor based pagination requires the results to be sorted by the unique key.
+    cursor_mark = "*"
+    num_found = 0
+    num_retrieved = 0
+
+    while True:
+
+        url = f"https://solr.calisphere.org/solr/query/?q=collection_url:https://registry.cdlib.org/api/v1/collection/{collection}/&wt=json&rows={rows}&sort=id+asc&cursorMark={quote(cursor_mark, safe='')}"
+
+        if terms:
+
+            url += f"&fq={quote(get_term_query(terms=terms), safe='')}"
+
+        response = http_client.get(url=url, headers=headers)
+
+        if not response.ok:    # pragma: no cover (should never be True during testing)
+
+            raise Exception(f"Error retrieving data from Calisphere, status code: {response.status_code}, reason: {response.reason}")
+
+        json_data = response.json()
+
+        num_found = json_data["response"]["numFound"]
+        docs = json_data["response"]["docs"]
+
+        for hit in docs:
+
+            num_retrieved += 1
+            yield hit
+
+        print(f"Calisphere collection {collection}: {num_retrieved} of {num_found} records retrieved ...", file=sys.stderr)
 
-                overview += ' ' + val
+        # The cursor stops changing once all the hits have been retrieved (but there is no
+        # need to ask for another page once we have all the hits Solr says there are).
+        next_cursor_mark = json_data.get("nextCursorMark")
+        if not docs or num_retrieved >= num_found or not next_cursor_mark or next_cursor_mark == cursor_mark:
 
-    return overview.lower()
+            break
+
+        cursor_mark = next_cursor_mark
+
+    if num_retrieved < num_found:
+
+        print(f"Warning: only {num_retrieved} of {num_found} records were retrieved for Calisphere collection {collection}", file=sys.stderr)
+
+
+def verify_term_query(collection, terms, expected_ids):
+    """
+    Check that filtering the collection by search term in Solr (see get_term_query()) gets
+    the same records as filtering all the collection's records ourselves (expected_ids).
+    """
+
+    ids = set()
+
+    for hit in get_collection_hits(collection=collection, terms=terms):
+
+        if matches_terms(hit=hit, terms=terms):
+
+            ids.add(hit.get("id"))
+
+    missing = expected_ids - ids
+    if missing:
+
+        print(f"Error: Solr's term filter for Calisphere collection {collection} misses {len(missing)} of {len(expected_ids)} records, e.g., {sorted(missing)[ : 5]}", file=sys.stderr)
+
+    else:
+
+        print(f"Solr's term filter for Calisphere collection {collection} gets all {len(expected_ids)} records", file=sys.stderr)
+
+
+def extract_collection(collection):
+    """
+    Returns the records for the given collection (an entry in collections), filtered
+    by the collection's search terms, if any.
+    """
+
+    records = []
+    terms = []
+
+    # Is this a collections with specific search terms?
+    if type(collection) is dict:
+
+        terms = collection["terms"]
+        collection = collection["id"]
+
+    # Check Solr's filtering by term against our own? If so, get all the collection's
+    # records and filter them ourselves, as the reference.
+    verify = terms and etl_env.do_verify_term_filters()
+    matched_ids = set()
+
+    # Note: Solr's filtering isn't guaranteed to keep every record that matches_terms()
+    # does (see get_term_query()), so it is only used when asked for.
+    solr_terms = terms if terms and etl_env.do_filter_terms_in_solr() and not verify else None
+
+    for hit in get_collection_hits(collection=collection, terms=solr_terms):
+
+        # Filter colletion results by term?
+        if terms and not matches_terms(hit=hit, terms=terms):
+
+            continue
+
+        matched_ids.add(hit.get("id"))
+
+        # Extract our data from the hit.
+        record = {}
+        for key in SOLR_KEYS:
+
+            if hit.get(key):
+
+                record[key] = hit[key]
+
+        records.append(record)
+
+        # Are we just testing?
+        if etl_env.are_tests_running():
+
+            break
+
+    if verify:
+
+        verify_term_query(collection=collection, terms=terms, expected_ids=matched_ids)
+
+    return records
 
 
 class CalisphereETLProcess(BaseETLProcess):
@@ -201,59 +391,41 @@ class CalisphereETLProcess(BaseETLProcess):
 
         data = []
 
-        # Search for each collection
-        for collection in collections:
-
-            terms = []
-
-            # Is this a collections with specific search terms?
-            if type(collection) is dict:
+        # Ids of the records extracted so far (a record can turn up in more than one collection).
+        record_ids = set()
 
-                terms = collection["terms"]
-                collection = collection["id"]
+        # Query collections concurrently?
+        max_requests = etl_env.get_max_requests()
+        if max_requests > 1 and not etl_env.are_tests_running():
 
-            url = f"https://solr.calisphere.org/solr/query/?q=collection_url:https://registry.cdlib.org/api/v1/collection/{collection}/&wt=json&indent=true&rows={rows}"
+            executor = ThreadPoolExecutor(max_workers=max_requests)
 
-            headers = { "X-Authentication-Token": api_key }
-            response = requests.get(url, headers=headers, timeout=60)
+            # Note: map() returns the results in the order of the collections.
+            results = executor.map(extract_collection, collections)
 
-            if not response.ok:    # pragma: no cover (should never be True during testing)
+        else:
 
-                raise Exception(f"Error retrieving data from Calisphere, status code: {response.status_code}, reason: {response.reason}")
+            executor = None
+            results = map(extract_collection, collections)
 
-            for hit in response.json()['response']['docs']:
+        try:
 
-                # Filter colletion results by term?
-                if terms:
+            for records in results:
 
-                    ignore = True
-                    overview = get_overview(hit=hit, keys=SOLR_KEYS)
+                for record in records:
 
-                    for term in terms:
-
-                        if term in overview:
-
-                            ignore = False
-                            break
-
-                    if ignore:
+                    if record.get("id") in record_ids:
 
                         continue
 
-                # Extract our data from the hit.
-                record = {}
-                for key in SOLR_KEYS:
-
-                    if hit.get(key):
-
-                        record[key] = hit[key]
+                    record_ids.add(record.get("id"))
+                    data.append(record)
 
-                data.append(record)
+        finally:
 
-                # Are we just testing?
-                if etl_env.are_tests_running():
+            if executor:
 
-                    break
+                executor.shutdown(cancel_futures=True)
 
         return data
 
@@ -1,14 +1,17 @@
 #!/usr/bin/env python
 
+from concurrent.futures import ThreadPoolExecutor
 import csv
-import requests
 import json
+import math
 import os
 import re
 import sys
+from urllib.parse import unquote_plus
 
 from bs4 import BeautifulSoup
 
+from etl import http_client
 from etl.etl_process import BaseETLProcess
 from etl.setup import ETLEnv
 from etl.tools import RhizomeField, remove_author_job_desc
@@ -86,6 +89,75 @@ def is_dimension(value):
     return re.search(r'\d.*x|X.*\d', value)
 
 
+def get_fields(terms, prefix=""):
+    """
+    Returns the DPLA field names (in dot notation) for the given terms (see dpla_terms).
+
+    Note: below the top level, a term's parent field is asked for as a whole (e.g.,
+    sourceResource.subject rather than sourceResource.subject.name), so that lists of
+    values come back in the same shape as in a full doc.
+    """
+
+    fields = []
+
+    for term in terms:
+
+        if type(term) is dict:
+
+            for parent, children in term.items():
+
+                if prefix:
+
+                    fields.append(prefix + parent)
+
+                else:
+
+                    fields += get_fields(terms=children, prefix=parent + ".")
+
+        else:
+
+            fields.append(prefix + term)
+
+    return fields
+
+def get_selected_fields():
+    """
+    Returns the fields to ask DPLA for, rather than the full docs: the fields in
+    dpla_terms, plus the original record's string (see parse_original_string()).
+    """
+
+    fields = get_fields(terms=dpla_terms) + [ "originalRecord.stringValue" ]
+
+    # Remove duplicates (keeping the order).
+    return list(dict.fromkeys(fields))
+
+def unflatten_fields(doc):
+    """
+    Returns the doc with any fields in dot notation (which is how DPLA returns selected
+    fields) turned back into nested fields, i.e., in the same shape as a full doc.
+    """
+
+    new_doc = {}
+
+    for field, value in doc.items():
+
+        parents = field.split(".")
+        name = parents.pop()
+
+        tree = new_doc
+        for parent in parents:
+
+            tree = tree.setdefault(parent, {})
+            if type(tree) is not dict:
+
+                break
+
+        else:
+
+            tree[name] = value
+
+    return new_doc
+
 def parse_json_terms(tree, terms):
 
     data = {}
@@ -130,8 +202,9 @@ def parse_json_terms(tree, terms):
 
 def parse_original_string(doc, record):
 
-    originalRecordString = doc["originalRecord"]
-    if type(originalRecordString) is str:
+    # Note: if we only asked DPLA for some of the fields, a string original record is left out.
+    originalRecordString = doc.get("originalRecord")
+    if originalRecordString is None or type(originalRecordString) is str:
 
         # Occasionally the metadata is in a URL somwewhere, and sometimes that url
         # may be unavailable (due to DNS error?) - luckily our curent data pull
@@ -200,10 +273,97 @@ def build_image_link(record):
             record["object"] = url + "/m1/1/med_res/"
 
 
-def extract_provider_records(provider, search_term=None):
+def get_page(provider, page, search_term=None):
+    """
+    Returns the json for the given page of DPLA's records for the provider. Limit the
+    results by the search term provided, if any.
+    """
+
+    provider_encoded = provider.replace(' ', '+')
+
+    url=f"{list_items_url}&page={page}&dataProvider={provider_encoded}"
+
+    if search_term:
+
+        url += f"&q={search_term}"
+
+    if etl_env.do_select_fields():
+
+        url += "&fields=" + ",".join(get_selected_fields())
+
+    response = http_client.get(url=url)
+    if not response.ok:
+
+        raise Exception(f"Error retrieving data from DPLA for {provider}, search_term: {search_term}, status code: {response.status_code}, reason: {response.reason}")
+
+    return response.json()
+
+def get_full_doc(doc_id):
+    "Returns the full DPLA doc with the given id."
+
+    url = f"{protocol}{domain}{list_items_path}/{doc_id}?api_key={api_key}"
+
+    response = http_client.get(url=url)
+    if not response.ok:
+
+        raise Exception(f"Error retrieving DPLA doc {doc_id}, status code: {response.status_code}, reason: {response.reason}")
+
+    return response.json()["docs"][0]
+
+def extract_record(doc):
+    "Returns the record for the given DPLA doc."
+
+    if etl_env.do_select_fields():
+
+        doc = unflatten_fields(doc=doc)
+
+    # Get the terms available for all DPLA records.
+    record = parse_json_terms(tree=doc, terms=dpla_terms)
+
+    # Records without a title need the rest of the doc (see below), so if we only asked
+    # for some of the fields, get the full doc.
+    if not record.get("title") and etl_env.do_select_fields():
+
+        doc = get_full_doc(doc_id=doc["id"])
+        record = parse_json_terms(tree=doc, terms=dpla_terms)
+
+    # Some records that are part of contributor collections have most of their metadata embedded in the sourceResource string.
+    if not record.get("title"):
+
+        for val in [ "title", "description" ]:
+
+            record[val] = doc['sourceResource'].get(val)
+
+    # Try to load metadata out of the original string as well.
+    parse_original_string(doc=doc, record=record)
+
+    # Try to add in a link to an image.
+    build_image_link(record=record)
+
+    return record
+
+def is_new_doc(doc, doc_ids):
+    """
+    Returns True if the doc hasn't been seen before (adding it to doc_ids, the ids of
+    the docs seen so far), so duplicates can be skipped before they are extracted.
+    """
+
+    if doc_ids is None:
+
+        return True
+
+    if doc.get("id") in doc_ids:
+
+        return False
+
+    doc_ids.add(doc.get("id"))
+
+    return True
+
+def extract_provider_records(provider, search_term=None, doc_ids=None):
     """
     Extract all records for the given provider. Limit the results by the search
-    term provided, if any.
+    term provided, if any. Docs whose ids are in doc_ids are skipped (see is_new_doc()).
     """
 
     data = []
@@ -213,22 +373,9 @@ def extract_provider_records(provider, search_term=None):
     start = 0
     page = 1
 
-    provider_encoded = provider.replace(' ', '+')
-
     while count > start and (page_max is None or page <= page_max):
 
-        url=f"{list_items_url}&page={page}&dataProvider={provider_encoded}"
-
-        if search_term:
-
-            url += f"&q={search_term}"
-
-        response = requests.get(url=url, timeout=60)
-        if not response.ok:
-
-            raise Exception(f"Error retrieving data from DPLA for {partner}, search_term: {search_term}, status code: {response.status_code}, reason: {response.reason}")
-
-        json_content = response.json()
+        json_content = get_page(provider=provider, page=page, search_term=search_term)
 
         count = json_content["count"]
         start = json_content["start"]
@@ -239,30 +386,221 @@ def extract_provider_records(provider, search_term=None):
 
         for doc in json_content["docs"]:
 
-            # Get the terms available for all DPLA records.
-            record = parse_json_terms(tree=doc, terms=dpla_terms)
+            if not is_new_doc(doc=doc, doc_ids=doc_ids):
 
-            # Some records that are part of contributor collections have most of their metadata embedded in the sourceResource string.
-            if not record.get("title"):
+                continue
 
-                for val in [ "title", "description" ]:
+            data.append(extract_record(doc=doc))
 
-                    record[val] = doc['sourceResource'].get(val)
+            if etl_env.are_tests_running():
 
-            # Try to load metadata out of the original string as well.
-            parse_original_string(doc=doc, record=record)
+                return data
 
-            # Try to add in a link to an image.
-            build_image_link(record=record)
+    return data
 
-            data.append(record)
+def get_num_pages(json_content):
+    "Returns the number of pages of records, given the json for the first page."
 
-            if etl_env.are_tests_running():
+    page_size = json_content.get("limit") or len(json_content["docs"]) or 1
+    num_pages = max(math.ceil(json_content["count"] / page_size), 1)
 
-                return data
+    return min(num_pages, page_max) if page_max else num_pages
+
+class ProviderPull():
+    """
+    The pages of records for a provider (and search term, if any), which are fetched
+    concurrently by extract_records_concurrently().
+    """
+
+    def __init__(self, provider, search_term=None):
+
+        self.provider = provider
+        self.search_term = search_term
+
+        # page -> future, for the pages that have been requested but not extracted yet.
+        self.pages = {}
+
+        # The next page to request.
+        self.next_page = 1
+
+        # Number of pages (known once the first page is in).
+        self.num_pages = None
+
+    def can_request_page(self):
+        "Returns True if there is another page to request (which we may not know until the first page is in)."
+
+        if self.next_page == 1:
+
+            return True
+
+        if self.num_pages is None:
+
+            first_page = self.pages.get(1)
+            if not first_page or not first_page.done() or first_page.exception():
+
+                return False
+
+            self.num_pages = get_num_pages(json_content=first_page.result())
+
+        return self.next_page <= self.num_pages
+
+    def request_page(self, executor):
+
+        self.pages[self.next_page] = executor.submit(get_page, provider=self.provider, page=self.next_page, search_term=self.search_term)
+        self.next_page += 1
+
+    def get_page(self, page):
+        "Returns the json for the given page (waiting for it, if necessary), and forgets about it."
+
+        json_content = self.pages.pop(page).result()
+
+        if page == 1:
+
+            self.num_pages = get_num_pages(json_content=json_content)
+
+        return json_content
+
+def request_pages(provider_pulls, curr_pull, executor, max_requests):
+    """
+    Request more pages, in the order they are extracted in, so that there are up to
+    2 * max_requests pages waiting to be extracted. At most max_requests of them are for
+    the pulls after the current one (e.g., their first pages, which tell us how many
+    pages they have), so the current pull's pages can always be fetched max_requests at
+    a time.
+    """
+
+    num_pending = sum(len(provider_pull.pages) for provider_pull in provider_pulls[curr_pull : ])
+    num_ahead = num_pending - len(provider_pulls[curr_pull].pages)
+
+    for idx in range(curr_pull, len(provider_pulls)):
+
+        provider_pull = provider_pulls[idx]
+
+        while num_pending < 2 * max_requests and (idx == curr_pull or num_ahead < max_requests) and provider_pull.can_request_page():
+
+            provider_pull.request_page(executor=executor)
+
+            num_pending += 1
+            if idx != curr_pull:
+
+                num_ahead += 1
+
+        if num_pending >= 2 * max_requests or num_ahead >= max_requests:
+
+            break
+
+def extract_records_concurrently(pulls, max_requests, doc_ids=None):
+    """
+    Same as calling extract_provider_records() for each (provider, search term) pull in
+    turn, but with up to max_requests pages being fetched at once. The pages are
+    extracted in the same order (on this thread), so the records are the same. Returns
+    the list of records for each pull.
+
+    Note: only a few pages are requested ahead of the one being extracted (see
+    request_pages()), and each page is dropped once it is extracted, so only a few
+    pages are held in memory at a time.
+    """
+
+    data = []
+
+    provider_pulls = [ ProviderPull(provider=provider, search_term=search_term) for provider, search_term in pulls ]
+
+    executor = ThreadPoolExecutor(max_workers=max_requests)
+
+    try:
+
+        for curr_pull, provider_pull in enumerate(provider_pulls):
+
+            pull_data = []
+            page = 1
+
+            while True:
+
+                request_pages(provider_pulls=provider_pulls, curr_pull=curr_pull, executor=executor, max_requests=max_requests)
+
+                json_content = provider_pull.get_page(page=page)
+
+                print(f"provider: {provider_pull.provider}, search term: {provider_pull.search_term}, page: {page} of {provider_pull.num_pages}, total docs: {json_content['count']}, curr docs: {len(pull_data)}", file=sys.stderr)
+
+                for doc in json_content["docs"]:
+
+                    if is_new_doc(doc=doc, doc_ids=doc_ids):
+
+                        pull_data.append(extract_record(doc=doc))
+
+                if page >= provider_pull.num_pages:
+
+                    break
+
+                page += 1
+
+            data.append(pull_data)
+
+    finally:
+
+        executor.shutdown(cancel_futures=True)
 
     return data
 
+def get_combined_search_term(search_terms):
+    "Returns a single search term that matches any of the given search terms."
+
+    return "+OR+".join(search_terms)
+
+def get_record_text(value):
+    "Returns all the text in the record value (which may be a list or dict), normalized for matching search terms."
+
+    if type(value) is str:
+
+        return value.lower().replace("-", " ")
+
+    if type(value) is list:
+
+        return "\0".join(get_record_text(value=tmp) for tmp in value)
+
+    if type(value) is dict:
+
+        return "\0".join(get_record_text(value=tmp) for tmp in value.values())
+
+    return ""
+
+def group_by_search_term(records, search_terms):
+    """
+    Given the records for a combined search term (see get_combined_search_term()), works
+    out which of the search terms each record matches (saved in the record's
+    "search_terms") and returns the records grouped by the first search term they match,
+    i.e., in roughly the order the records would have been found by searching for each
+    term in turn. Records that don't seem to match any of the terms (e.g., because DPLA
+    matched a variation of a term) are put last.
+
+    Note: within each group, the records are in the order DPLA returned them for the
+    combined search, which (since DPLA sorts by relevance to the whole query) isn't
+    necessarily the order they come in when searching for the term by itself - only the
+    set of records is the same.
+    """
+
+    # Note: search terms are url-encoded, and may be quoted phrases.
+    phrases = [ unquote_plus(search_term).strip('"').lower().replace("-", " ") for search_term in search_terms ]
+
+    groups = [ [] for search_term in search_terms ]
+    unmatched = []
+
+    for record in records:
+
+        text = get_record_text(value=record)
+
+        record["search_terms"] = [ search_term for search_term, phrase in zip(search_terms, phrases) if phrase in text ]
+
+        if record["search_terms"]:
+
+            groups[search_terms.index(record["search_terms"][0])].append(record)
+
+        else:
+
+            unmatched.append(record)
+
+    return [ record for group in groups for record in group ] + unmatched
+
 
 class DPLAETLProcess(BaseETLProcess):
 
@@ -304,24 +642,48 @@ class DPLAETLProcess(BaseETLProcess):
 
     def extract(self):
 
-        data = []
+        combine_search_terms = etl_env.do_combine_search_terms()
+
+        # (provider, search term) for each of the pulls we are interested in.
+        pulls = []
 
-        # Extract the records for the providers we are interested in.
         for provider, search_terms in providers.items():
 
-            if search_terms:
+            # Search for all of the provider's search terms at once?
+            if search_terms and combine_search_terms:
 
-                provider_data = []
+                pulls.append((provider, get_combined_search_term(search_terms=search_terms)))
 
-                for search_term in search_terms:
+            else:
 
-                    provider_data += extract_provider_records(provider=provider, search_term=search_term)
+                for search_term in search_terms or [ None ]:
 
-            else:
+                    pulls.append((provider, search_term))
+
+        # Ids of the docs extracted so far (the search terms overlap, so many docs are
+        # found more than once).
+        doc_ids = set()
+
+        # Fetch pages concurrently?
+        max_requests = etl_env.get_max_requests()
+        if max_requests > 1 and not etl_env.are_tests_running():
+
+            results = extract_records_concurrently(pulls=pulls, max_requests=max_requests, doc_ids=doc_ids)
+
+        else:
+
+            # Extract the records for the providers we are interested in.
+            results = [ extract_provider_records(provider=provider, search_term=search_term, doc_ids=doc_ids) for provider, search_term in pulls ]
+
+        data = []
+
+        for (provider, search_term), records in zip(pulls, results):
+
+            if combine_search_terms and providers[provider]:
 
-                provider_data = extract_provider_records(provider=provider)
+                records = group_by_search_term(records=records, search_terms=providers[provider])
 
-            data += provider_data
+            data += records
 
         return data
 
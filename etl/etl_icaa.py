@@ -1,17 +1,34 @@
 #!/usr/bin/env python
 
+from concurrent.futures import ThreadPoolExecutor
 import json
+import os
 import re
-import requests
+import shutil
 import sys
 import time
 
+from etl import http_client
 from etl.etl_process import BaseETLProcess
 from etl.setup import ETLEnv
-from etl.tools import RhizomeField, remove_html_tags
+from etl.tools import RhizomeField, read_json, remove_html_tags, write_json_atomic
 from etl.date_parsers import get_date_first_four
 
 
+IMAGE_URL_CACHE_PATH = "etl/data/icaa/image_urls.json"
+
+# Where the pages of items downloaded for each keyword are saved (see ItemsCheckpoint).
+ITEMS_DIR = "etl/data/icaa/items"
+ITEMS_CHECKPOINT_PATH = "etl/data/icaa/items/checkpoint.json"
+
+# Number of items to download per page.
+per_page = 250
+
+# Seconds that a cached image url is used before it is looked up again (if None, cached
+# image urls are always used - they almost never change).
+IMAGE_URL_MAX_AGE = None
+
+
 field_map = {
     "o:id":                             RhizomeField.ID,
     "o:title":                          RhizomeField.TITLE,
@@ -32,29 +49,132 @@ field_map = {
 
 
 
-def extract_image_url(record):
+def get_media_url(record):
+    "Returns the url of the record's (first) media item in the API, if any."
 
     media = record.get("o:media")
     if media:
 
-        media_url = media[0]["@id"]
+        return media[0]["@id"]
+
+    return None
 
-        response = requests.get(media_url, timeout=60)
-        if not response.ok:
+def get_image_url(media_url):
+    "Returns the image url for the given media item."
 
-            raise Exception(f"ICAA API returned error {response.status_code} trying to retrieve image url")
+    response = http_client.get(url=media_url)
+    if not response.ok:
 
-        image_json = response.json()
-        thumbnail_urls = image_json.get("o:thumbnail_urls")
-        if thumbnail_urls:
+        raise Exception(f"ICAA API returned error {response.status_code} trying to retrieve image url")
+
+    image_json = response.json()
+    thumbnail_urls = image_json.get("o:thumbnail_urls")
+    if thumbnail_urls:
+
+        image_url = thumbnail_urls.get("large")
+        if image_url:
+
+            return "https://icaa.mfah.org" + image_url
+
+    return None
+
+def extract_image_url(record):
 
-            image_url = thumbnail_urls.get("large")
-            if image_url:
+    media_url = get_media_url(record=record)
+    if media_url:
 
-                return "https://icaa.mfah.org" + image_url
+        return get_image_url(media_url=media_url)
 
     return None
 
+class ImageUrlCache():
+    "The image urls looked up for media items in previous runs, saved between runs."
+
+    def __init__(self, path=IMAGE_URL_CACHE_PATH):
+
+        self.path = path
+
+        # media url -> { "image_url": image url (or None), "stored": time it was looked up }
+        self.entries = read_json(file_path=path, default={})
+
+    def get(self, media_url):
+        "Returns the cache entry for the given media url, or None if it isn't cached (or is stale)."
+
+        entry = self.entries.get(media_url)
+        if entry and IMAGE_URL_MAX_AGE is not None and time.time() - entry["stored"] > IMAGE_URL_MAX_AGE:
+
+            return None
+
+        return entry
+
+    def put(self, media_url, image_url):
+
+        self.entries[media_url] = { "image_url": image_url, "stored": time.time() }
+
+    def save(self):
+
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        write_json_atomic(file_path=self.path, data=self.entries)
+
+def get_image_urls(records, cache=None):
+    """
+    Returns a dict of media url -> image url for the given records' media. Media that
+    aren't in the cache (if any) are looked up by up to --max_requests threads at once,
+    at the rate allowed for the ICAA server (see HOST_CONFIG in http_client.py), and
+    added to the cache.
+    """
+
+    media_urls = list(dict.fromkeys(filter(None, [ get_media_url(record=record) for record in records ])))
+
+    image_urls = {}
+
+    if cache:
+
+        for media_url in media_urls:
+
+            entry = cache.get(media_url=media_url)
+            if entry:
+
+                image_urls[media_url] = entry["image_url"]
+
+        if media_urls:
+
+            print(f"{len(image_urls)} of {len(media_urls)} ICAA image urls found in the cache", file=sys.stderr)
+
+        media_urls = [ media_url for media_url in media_urls if media_url not in image_urls ]
+
+    max_requests = ETLEnv.instance().get_max_requests()
+    executor = ThreadPoolExecutor(max_workers=max_requests) if max_requests > 1 else None
+
+    try:
+
+        results = executor.map(get_image_url, media_urls) if executor else map(get_image_url, media_urls)
+
+        for num_retrieved, (media_url, image_url) in enumerate(zip(media_urls, results), start=1):
+
+            image_urls[media_url] = image_url
+
+            if cache:
+
+                cache.put(media_url=media_url, image_url=image_url)
+
+            if num_retrieved % 25 == 0:
+
+                print(f"{num_retrieved} ICAA image urls retrieved ...", file=sys.stderr)
+
+    finally:
+
+        if executor:
+
+            executor.shutdown(cancel_futures=True)
+
+        # Keep whatever was looked up, even if a lookup failed.
+        if cache:
+
+            cache.save()
+
+    return image_urls
+
 def extract_field(record, field):
     "Extract metadata for the given field for the record."
 
@@ -102,8 +222,11 @@ def extract_field(record, field):
 
         return record.get(field)
 
-def extract_record(record):
-    "Extracts metadata for the given record."
+def extract_record(record, image_urls=None):
+    """
+    Extracts metadata for the given record. If image_urls (see get_image_urls()) is
+    given, the record's image url is taken from it rather than looked up.
+    """
 
     record_data = {}
 
@@ -115,7 +238,13 @@ def extract_record(record):
 
         elif field == "o:media":
 
-            value = extract_image_url(record=record)
+            if image_urls is not None:
+
+                value = image_urls.get(get_media_url(record=record))
+
+            else:
+
+                value = extract_image_url(record=record)
 
         else:
 
@@ -126,6 +255,113 @@ def extract_record(record):
     return record_data
 
 
+class ItemsCheckpoint():
+    """
+    The pages of items downloaded so far for each keyword (the pages themselves are saved
+    in ITEMS_DIR). It is rewritten atomically after every page, so an interrupted
+    extraction can be resumed without downloading those pages again.
+    """
+
+    def __init__(self, keywords=None):
+
+        # keyword -> number of pages downloaded
+        self.keywords = keywords or {}
+
+    @staticmethod
+    def start():
+        "Returns a new, empty checkpoint (removing any pages saved by an earlier extraction)."
+
+        shutil.rmtree(ITEMS_DIR, ignore_errors=True)
+        os.makedirs(ITEMS_DIR)
+
+        checkpoint = ItemsCheckpoint()
+        checkpoint.save()
+
+        return checkpoint
+
+    @staticmethod
+    def load():
+
+        data = read_json(file_path=ITEMS_CHECKPOINT_PATH)
+        if data is None:
+
+            raise Exception(f"No ICAA checkpoint found ({ITEMS_CHECKPOINT_PATH}), so the extraction can't be resumed")
+
+        print(f"Resuming ICAA extraction, {sum(data['keywords'].values())} pages already downloaded", file=sys.stderr)
+
+        return ItemsCheckpoint(keywords=data["keywords"])
+
+    def save(self):
+
+        write_json_atomic(file_path=ITEMS_CHECKPOINT_PATH, data={ "keywords": self.keywords })
+
+    @staticmethod
+    def get_page_path(keyword, page):
+
+        return os.path.join(ITEMS_DIR, f"{re.sub(r'[^A-Za-z0-9]', '_', keyword)}_{page}.json")
+
+    def get_page(self, keyword, page):
+        "Returns the given page of items, if it has already been downloaded (otherwise None)."
+
+        if page > self.keywords.get(keyword, 0):
+
+            return None
+
+        return read_json(file_path=self.get_page_path(keyword=keyword, page=page))
+
+    def add_page(self, keyword, page, items):
+
+        write_json_atomic(file_path=self.get_page_path(keyword=keyword, page=page), data=items)
+
+        # Note: a page that is downloaded again (e.g., because its file was missing) doesn't undo the later pages.
+        self.keywords[keyword] = max(page, self.keywords.get(keyword, 0))
+        self.save()
+
+def get_items_page(keyword, page):
+    "Returns the given page of ICAA items for the keyword."
+
+    # Note: sort by id, so the pages stay the same if the extraction is resumed later.
+    url = f"https://icaa.mfah.org/api/items?per_page={per_page}&page={page}&sort_by=id&sort_order=asc&fulltext_search={keyword}"
+
+    response = http_client.get(url=url)
+
+    if not response.ok:    # pragma: no cover (should never be True during testing)
+
+        raise Exception(f"Error retrieving data from ICAA, status code: {response.status_code}, reason: {response.reason}")
+
+    return response.json()
+
+def get_keyword_items(keyword, checkpoint=None):
+    """
+    Yields the pages of ICAA items for the keyword, one page at a time. Pages that have
+    already been downloaded (see ItemsCheckpoint) are read from disk rather than
+    downloaded again, and new pages are added to the checkpoint.
+    """
+
+    page = 1
+
+    while True:
+
+        items = checkpoint.get_page(keyword=keyword, page=page) if checkpoint else None
+
+        if items is None:
+
+            items = get_items_page(keyword=keyword, page=page)
+
+            if checkpoint:
+
+                checkpoint.add_page(keyword=keyword, page=page, items=items)
+
+        yield items
+
+        # The last page is the one that isn't full.
+        if len(items) < per_page:
+
+            break
+
+        page += 1
+
+
 class ICAAETLProcess(BaseETLProcess):
 
     def __init__(self, format):
@@ -162,39 +398,77 @@ class ICAAETLProcess(BaseETLProcess):
 
     def extract(self):
 
+        etl_env = ETLEnv.instance()
+
         data = []
 
-        for keyword in self.keywords:
+        # Ids of the records retrieved so far - the keywords overlap a lot, so skip any record
+        # we already have before doing any more work on it (such as looking up its image url).
+        record_ids = set()
+
+        # Note: the tests need every image url to be looked up, and every page downloaded.
+        image_url_cache = ImageUrlCache() if not etl_env.are_tests_running() else None
+        checkpoint = None
+
+        if not etl_env.are_tests_running():
+
+            # Resume an interrupted extraction? Note: the offset is 0 for --resume_download=0, so check for None.
+            if etl_env.get_call_offset() is not None:
+
+                checkpoint = ItemsCheckpoint.load()
+
+            else:
+
+                checkpoint = ItemsCheckpoint.start()
+
+        try:
 
-            url = f"https://icaa.mfah.org/api/items?per_page=1000&fulltext_search={keyword}"
+            for keyword in self.keywords:
 
-            response = requests.get(url, timeout=60)
+                num_dupes = 0
 
-            if not response.ok:    # pragma: no cover (should never be True during testing)
+                for page, items in enumerate(get_keyword_items(keyword=keyword, checkpoint=checkpoint), start=1):
 
-                raise Exception(f"Error retrieving data from ICAA, status code: {response.status_code}, reason: {response.reason}")
+                    print(f"\nProcessing {len(items)} ICAA records for keyword {keyword}, page {page} ...\n", file=sys.stderr)
 
-            json_data = response.json()
+                    records = []
 
-            print(f"\nProcessing {len(json_data)} ICAA records for keyword {keyword}...\n", file=sys.stderr)
-            num_retrieved = 0
+                    for record in items:
 
-            for record in json_data:
+                        if record.get("o:id") in record_ids:
 
-                record = extract_record(record=record)
-                data.append(record)
+                            num_dupes += 1
+                            continue
 
-                if ETLEnv.instance().are_tests_running():
+                        record_ids.add(record.get("o:id"))
+                        records.append(record)
 
-                    break
+                        if etl_env.are_tests_running():
 
-                num_retrieved += 1
-                if num_retrieved % 25 == 0:
+                            break
+
+                    # Look up the records' image urls (concurrently, if allowed).
+                    image_urls = get_image_urls(records=records, cache=image_url_cache)
+
+                    for record in records:
+
+                        data.append(extract_record(record=record, image_urls=image_urls))
+
+                    if etl_env.are_tests_running():
+
+                        break
+
+                if num_dupes:
+
+                    print(f"Skipped {num_dupes} ICAA records already retrieved for an earlier keyword", file=sys.stderr)
 
-                    print(f"{num_retrieved} ICAA records retrieved ...", file=sys.stderr)
+        except Exception:
 
-                    # Sleep a bit to try to keep from overwhelming the server.
-                    time.sleep(5)
+            if checkpoint:
+
+                print("The ICAA extraction stopped - to resume it (without downloading the pages already downloaded), use --resume_download=yes", file=sys.stderr)
+
+            raise
 
         return data
 
@@ -228,14 +502,22 @@ class ICAAETLProcess(BaseETLProcess):
 
                 record["dcterms:creator/o:label"] = artists
 
-            # Remove html tags from certain values.
-            for field in [ "dcterms:description/@value", "bibo:annotates/@value" ]:
+        # Remove html tags from certain values (a whole column of values at a time).
+        for field in [ "dcterms:description/@value", "bibo:annotates/@value" ]:
+
+            records = [ record for record in data if record.get(field) ]
+
+            for record in records:
+
+                if type(record[field]) is not list:
+
+                    record[field] = [ record[field] ]
+
+            values = iter(remove_html_tags(values=[ value for record in records for value in record[field] ]))
 
-                values = record.get(field)
-                if values:
+            for record in records:
 
-                    values = remove_html_tags(values=values)
-                    record[field] = values
+                record[field] = [ next(values) for value in record[field] ]
 
         super().transform(data=data)
 
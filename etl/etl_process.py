@@ -264,7 +264,7 @@ class BaseETLProcess(abc.ABC):
         # Remove records that are already loaded in the rhizomes website?
         if not self.etl_env.do_rebuild_previous_items():
 
-            previous_record_urls = get_previous_item_ids()
+            urls = []
 
             for record in data:
 
@@ -278,7 +278,14 @@ class BaseETLProcess(abc.ABC):
 
                     raise Exception(f"URL for record {record[RhizomeField.ID.value]} is a list - lists of urls are not supported.")
 
-                if url in previous_record_urls:
+                urls.append(url)
+
+            # Note: for small pulls, the urls may be looked up in the website, rather than retrieving every item in it.
+            previous_record_urls = get_previous_item_ids(urls=urls)
+
+            for record in data:
+
+                if not record.get("ignore", False) and record[RhizomeField.URL.value] in previous_record_urls:
 
                     record["ignore"] = True
 
@@ -1,19 +1,24 @@
 #!/usr/bin/env python
 
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from html import unescape
+import gzip
+import hashlib
+import io
+import json
 import os
+import queue
 import re
-import requests
-import shutil
+import sqlite3
 import sys
-import time
+import threading
 
+from etl import http_client
 from etl.etl_process import BaseETLProcess
 from etl.setup import ETLEnv
-from etl.tools import RhizomeField, get_oaipmh_record
+from etl.tools import RhizomeField, get_oaipmh_element_record, iter_oaipmh_elements, read_json, write_json_atomic
 from etl.date_parsers import *
 
-from bs4 import BeautifulSoup
-
 
 protocol = "https://"
 domain = "texashistory.unt.edu"
@@ -30,6 +35,12 @@ start_records_path = records_path + "&metadataPrefix=oai_dc"
 start_records_url = protocol + domain + start_records_path
 resume_records_url = protocol + domain + records_path
 
+# Manifest of the pages downloaded so far (see Checkpoint).
+CHECKPOINT_PATH = "etl/data/pth/checkpoint.json"
+
+# Local copy of PTH's records, for incremental downloads (see RecordStore).
+STORE_PATH = "etl/data/pth_store.db"
+
 
 field_map = {
     "identifier":                             RhizomeField.ID,
@@ -368,154 +379,759 @@ def de_dupe_substrings(values):
     return list(values)
 
 
-class ResumptionToken():
+def start_download():
+    "Set up a new, empty metadata directory for a full download."
 
-    # Singleton instance.
-    __instance = None
+    # Rename current metadata directory first to indicate it is old.
+    if os.path.exists("etl/data/pth"):
 
-    def __init__(self):
-        # Make sure only 1 instance of ResumptionToken is created
+        if os.path.exists("etl/data/pth_old"):
 
-        if ResumptionToken.__instance:    # pragma: no cover (should never get here)
+            raise Exception("Error: it looks like etl/data/pth_old still exists - please back it up or remove it.")
 
-            raise Exception("call ResumptionToken.instance() to get access to ResumptionToken")
+        os.rename("etl/data/pth", "etl/data/pth_old")
 
-        self.token = None
+    os.mkdir("etl/data/pth")
 
-    def instance():
-        """
-        Should return one-and-only instance of this class.
-        """
+def fetch_page(url, allow_no_records=False):
+    """
+    Download one page of PTH's metadata, retrying if necessary. If allow_no_records is
+    True, returns None (rather than raising an exception) if no records match the request.
+    """
+
+    # Note: server errors and timeouts are retried by the http client (see http_client.HOST_CONFIG).
+    response = http_client.get(url=url)
+    if not response.ok:
+
+        raise Exception(f"Error retrieving data from PTH, status code: {response.status_code}, reason: {response.reason}\nurl: {url}")
+
+    # Force the encoding to be utf-8 (apparently it looks like ISO-8859-1 to requests.get() ... )
+    response.encoding = "utf-8"
+
+    # Oheck for search errors.
+    code, message = get_error(content=response.content)
+    if code:
+
+        if allow_no_records and code == "noRecordsMatch":
+
+            return None
+
+        raise Exception(message)
+
+    return response
+
+def get_error(content):
+    "Returns the (code, message) of the error in the OAIPMH xml, if any."
+
+    match = re.search(rb'<error(?:\s+code="([^"]*)")?[^>]*>([^<]*)</error>', content)
+    if match:
+
+        code = (match.group(1) or b"error").decode("utf-8")
+
+        return code, unescape(match.group(2).decode("utf-8"))
+
+    return None, None
+
+def get_resumption_token(content):
+    "Returns the resumption token in the OAIPMH xml, if any."
+
+    # Note: a regex is used here so the token can be found without parsing the whole page.
+    match = re.search(rb'<resumptionToken[^>]*>([^<]*)</resumptionToken>', content)
+    if match:
+
+        return unescape(match.group(1).decode("utf-8"))
+
+    return None
+
+def get_response_date(content):
+    "Returns the response date in the OAIPMH xml, if any."
+
+    match = re.search(rb'<responseDate[^>]*>([^<]*)</responseDate>', content)
+    if match:
 
-        if ResumptionToken.__instance is None:
-            ResumptionToken.__instance = ResumptionToken()
+        return match.group(1).decode("utf-8").strip()
 
-        return ResumptionToken.__instance
+    return None
 
+def write_file(file_num, content):
 
-def get_data_impl(num_calls=0, resume=False):
+    # Store the page compressed, along with an index of its records?
+    if ETLEnv.instance().do_compress_cache():
+
+        write_compressed_file(file_num=file_num, content=content)
+        return
+
+    with open(f"etl/data/pth/pth_{file_num}.xml", "wb") as output:
+
+        output.write(content)
+
+def get_header_values(header, name):
+    "Returns the values of the named element in the given OAIPMH record header xml."
+
+    values = re.findall(b'<' + name + b'>([^<]*)</' + name + b'>', header)
+
+    return [ unescape(value.decode("utf-8")).strip() for value in values ]
+
+def get_record_index(content):
     """
-    Download PTH's metadata.
+    Returns an index of the records in the given OAIPMH xml: the byte offset and length
+    of each record, along with the identifier, setSpecs and datestamp from its header.
     """
 
-    resumption_token = ResumptionToken.instance()
+    records = []
 
-    # Resume a previous download?
-    if resume:
+    # Note: regexes are used here so the index can be built without parsing the whole page.
+    for match in re.finditer(rb'<record\b[^>]*>.*?</record>', content, re.S):
 
-        if not num_calls:
+        header = re.search(rb'<header\b[^>]*>(.*?)</header>', match.group(0), re.S)
+        header = header.group(1) if header else b""
 
-            raise Exception("num_calls is required to resume get_data_impl()")
+        identifiers = get_header_values(header=header, name=b"identifier")
+        datestamps = get_header_values(header=header, name=b"datestamp")
 
-        data = read_file(file_num=num_calls)
-        if not data:
+        records.append({
+            "offset": match.start(),
+            "length": match.end() - match.start(),
+            "identifier": identifiers[0] if identifiers else None,
+            "setSpec": get_header_values(header=header, name=b"setSpec"),
+            "datestamp": datestamps[0] if datestamps else None,
+        })
 
-            raise Exception(f"File not found for num_calls: {num_calls}")
+    return records
 
-        last_xml_data = BeautifulSoup(markup=data, features="lxml-xml", from_encoding="utf-8")
+def write_compressed_file(file_num, content):
+    "Write the page gzipped, along with a sidecar index of its records (see get_record_index())."
 
-        resumption_tokens = last_xml_data.find_all("resumptionToken")
+    with gzip.open(f"etl/data/pth/pth_{file_num}.xml.gz", "wb", compresslevel=6) as output:
 
-        if resumption_tokens:
+        output.write(content)
 
-            resumption_token.token = resumption_tokens[0].text
+    with gzip.open(f"etl/data/pth/pth_{file_num}.idx.json.gz", "wt", compresslevel=6) as output:
 
-        else:
+        json.dump({ "size": len(content), "records": get_record_index(content=content) }, output)
+
+# The files that make up a downloaded page (compressed files have a sidecar index).
+FILE_SUFFIXES = [ ".xml", ".xml.gz", ".idx.json.gz" ]
+
+def remove_files(file_num):
+    "Remove the given downloaded file (and its index, if any)."
+
+    for suffix in FILE_SUFFIXES:
+
+        if os.path.exists(f"etl/data/pth/pth_{file_num}{suffix}"):
+
+            os.remove(f"etl/data/pth/pth_{file_num}{suffix}")
+
+def get_file_path(file_num):
+    "Returns the path of the given downloaded file, which may be compressed (see write_compressed_file())."
+
+    file_path = f"etl/data/pth/pth_{file_num}.xml"
+
+    if not os.path.exists(file_path) and os.path.exists(file_path + ".gz"):
+
+        return file_path + ".gz"
+
+    return file_path
+
+def get_checksum(file_path):
+    "Returns the sha256 checksum of the given file."
+
+    checksum = hashlib.sha256()
+
+    with open(file_path, "rb") as input:
+
+        for chunk in iter(lambda: input.read(1024 * 1024), b""):
+
+            checksum.update(chunk)
+
+    return checksum.hexdigest()
+
+class Checkpoint():
+    """
+    Manifest of the PTH files downloaded so far: for each file, the resumption token for
+    the next page, along with the number of records in the file and the file's size and
+    checksum (so a partially written file can be spotted). It is rewritten atomically after
+    every page, so an interrupted download can be resumed straight from it.
+    """
+
+    def __init__(self, pages=None):
+
+        self.pages = pages or []
+
+    @staticmethod
+    def load():
+
+        data = read_json(file_path=CHECKPOINT_PATH)
+        if data is None:
+
+            raise Exception(f"No PTH download checkpoint found ({CHECKPOINT_PATH}), so the download can't be resumed")
+
+        return Checkpoint(pages=data["pages"])
+
+    def save(self):
+
+        write_json_atomic(file_path=CHECKPOINT_PATH, data={ "pages": self.pages })
+
+    def add_page(self, file_num, content, token):
+        "Add the page that has just been written to the given file (replacing any later pages)."
+
+        file_path = get_file_path(file_num=file_num)
+
+        del self.pages[file_num : ]
+
+        self.pages.append({
+            "page": file_num,
+            "file": os.path.basename(file_path),
+            "token": token,
+            "records": len(re.findall(rb'<record\b', content)),
+            "size": os.path.getsize(file_path),
+            "checksum": get_checksum(file_path=file_path),
+        })
+
+        self.save()
+
+    def get_record_count(self):
+
+        return sum(page["records"] for page in self.pages)
+
+    def is_page_intact(self, page, verify_checksum=False):
+        "Returns True if the page's file matches the checkpoint."
+
+        file_path = f"etl/data/pth/{page['file']}"
+
+        if not os.path.exists(file_path) or os.path.getsize(file_path) != page["size"]:
 
             return False
 
-    if not resumption_token.token:
+        return not verify_checksum or get_checksum(file_path=file_path) == page["checksum"]
+
+    def get_resume_point(self, file_num=None):
+        """
+        Returns (number of the next file to download, resumption token to download it with)
+        for resuming after the given file (or after the last file, if file_num is None). Files
+        that are missing or don't match the checkpoint (e.g., because they were only partially
+        written) are downloaded again.
+        """
 
-        # Rename current metadata directory first to indicate it is old.
-        if os.path.exists("etl/data/pth"):
+        last = len(self.pages) - 1 if file_num is None else min(file_num, len(self.pages) - 1)
 
-            if os.path.exists("etl/data/pth_old"):
+        # Checking the size of every file is quick ...
+        for page in self.pages[ : last + 1]:
 
-                raise Exception("Error: it looks like etl/data/pth_old still exists - please back it up or remove it.")
+            if not self.is_page_intact(page=page):
 
-            os.rename("etl/data/pth", "etl/data/pth_old")
+                print(f"PTH file {page['file']} is missing or incomplete, so it will be downloaded again ...", file=sys.stderr)
 
-        os.mkdir("etl/data/pth")
+                last = page["page"] - 1
+                break
 
-        num_calls = 0
+        # ... but only the file we resume from has its checksum verified.
+        while last >= 0 and not self.is_page_intact(page=self.pages[last], verify_checksum=True):
+
+            print(f"PTH file {self.pages[last]['file']} does not match its checksum, so it will be downloaded again ...", file=sys.stderr)
+
+            last -= 1
+
+        if last < 0:
+
+            return 0, None
+
+        return last + 1, self.pages[last]["token"]
+
+def get_data_impl(checkpoint, num_calls=0, token=None):
+    """
+    Download a page of PTH's metadata (the first page, or the page for the given resumption
+    token) into file num_calls, and add it to the checkpoint. Returns the resumption token
+    for the next page, if there is one.
+    """
 
-        url = start_records_url
+    url = f"{resume_records_url}&resumptionToken={token}" if token else start_records_url
+
+    response = fetch_page(url=url)
+
+    write_file(file_num=num_calls, content=response.content)
+
+    token = get_resumption_token(content=response.content)
+
+    checkpoint.add_page(file_num=num_calls, content=response.content, token=token)
+    curr_record_count = checkpoint.get_record_count()
+
+    # Loop through next set of data (if any).
+    if token:
+
+        print(f"{curr_record_count} PTH records retrieved ...", file=sys.stderr)
+
+        return None if RECORD_LIMIT and curr_record_count >= RECORD_LIMIT else token
 
     else:
 
-        url = f"{resume_records_url}&resumptionToken={resumption_token.token}"
+        print(f"Finished retrieving PTH records - {curr_record_count} records retrieved ...", file=sys.stderr)
 
-        if ETLEnv.instance().are_tests_running():
+        return None
+
+def get_data(num_calls=0, resume=False):
+    """
+    Download PTH's metadata. If resume is True, an interrupted download is continued
+    (using the checkpoint) after file num_calls, or after the last file that was
+    downloaded if num_calls is negative.
+    """
+
+    token = None
+
+    if resume:
+
+        checkpoint = Checkpoint.load()
+
+        num_calls, token = checkpoint.get_resume_point(file_num=num_calls if num_calls >= 0 else None)
+        if num_calls and not token:
+
+            print("The PTH download has already finished, there is nothing to resume", file=sys.stderr)
 
             return
 
-    success = False
-    for reps in (range(0, 3)):
+        # Any files after the resume point will be downloaded again.
+        for page in checkpoint.pages[num_calls : ]:
+
+            remove_files(file_num=page["page"])
+
+        del checkpoint.pages[num_calls : ]
+
+        print(f"Resuming PTH download at file {num_calls} ({checkpoint.get_record_count()} records already retrieved) ...", file=sys.stderr)
+
+    else:
+
+        start_download()
+
+        checkpoint = Checkpoint()
+        num_calls = 0
+
+    try:
 
-        response = requests.get(url, timeout=120)
-        if response.ok:
+        while True:
 
-            success = True
+            token = get_data_impl(checkpoint=checkpoint, num_calls=num_calls, token=token)
+            if not token:
+
+                break
+
+            num_calls += 1
+
+    except Exception:
+
+        print(f"The PTH download stopped at file {num_calls} - to resume it, use --resume_download=yes", file=sys.stderr)
+        raise
+
+class PageQueue():
+    """
+    Downloaded pages waiting to be extracted, shared between the download thread(s) and
+    the thread extracting the records. Only a few pages are buffered, so a slow parser
+    doesn't let downloaded pages pile up in memory.
+    """
+
+    def __init__(self, maxsize):
+
+        self.queue = queue.Queue(maxsize=maxsize)
+        self.cancelled = threading.Event()
+
+    def put(self, item):
+        "Add the item to the queue, waiting for room if necessary (unless the queue has been cancelled)."
+
+        while not self.cancelled.is_set():
+
+            try:
+
+                self.queue.put(item, timeout=1)
+                return
+
+            except queue.Full:
+
+                pass
+
+        raise Exception("PTH download cancelled")
+
+    def get(self):
+
+        return self.queue.get()
+
+    def cancel(self):
+        "Stop any download threads that are waiting to add pages."
+
+        self.cancelled.set()
+
+def download_pages(pages, set_num=0, set_spec=None):
+    """
+    Download PTH's metadata (or just the metadata for the given set), putting
+    (set_num, page number, page content) onto the pages queue as each page arrives.
+    """
+
+    label = f"PTH {set_spec}" if set_spec else "PTH"
+
+    page_num = 0
+    url = start_records_url
+    if set_spec:
+
+        url += f"&set={set_spec}"
+
+    while url:
+
+        response = fetch_page(url=url, allow_no_records=bool(set_spec))
+        if not response:
+
+            print(f"No records found for {label}", file=sys.stderr)
             break
 
+        token = get_resumption_token(content=response.content)
+
+        pages.put((set_num, page_num, response.content))
+
+        page_num += 1
+        curr_record_count = page_num * 1000
+
+        if token and not (RECORD_LIMIT and curr_record_count >= RECORD_LIMIT):
+
+            print(f"{curr_record_count} {label} records retrieved ...", file=sys.stderr)
+
+            url = f"{resume_records_url}&resumptionToken={token}"
+
         else:
 
-            print(f"Error retrieving data from PTH, status code: {response.status_code}, reason: {response.reason}\nurl: {url}")
+            print(f"Finished retrieving {label} records - {curr_record_count} records retrieved ...", file=sys.stderr)
 
+            url = None
 
-            time.sleep(60)
+def download_all_pages(pages, set_specs=None):
+    """
+    Download all of PTH's metadata (or just the metadata for the given sets, up to
+    max_requests sets at a time), then put None onto the pages queue (or the exception,
+    if something went wrong).
+    """
 
-    if not success:
+    try:
 
-        raise Exception(f"Error retrieving data from PTH (tried 3 times), status code: {response.status_code}, reason: {response.reason}\nurl: {url}")
+        if set_specs is None:
 
-    # Force the encoding to be utf-8 (apparently it looks like ISO-8859-1 to requests.get() ... )
-    response.encoding = "utf-8"
+            download_pages(pages=pages)
 
-    xml_data = BeautifulSoup(markup=response.content, features="lxml-xml", from_encoding="utf-8")
+        else:
 
-    # Oheck for search errors.
-    errors = xml_data.find_all("error")
-    if errors:
+            with ThreadPoolExecutor(max_workers=ETLEnv.instance().get_max_requests()) as executor:
 
-        raise Exception(errors[0].text)
+                futures = [ executor.submit(download_pages, pages=pages, set_num=set_num, set_spec=set_spec) for set_num, set_spec in enumerate(set_specs) ]
 
-    with open(f"etl/data/pth/pth_{num_calls}.xml", "w") as output:
+                for future in as_completed(futures):
 
-        output.write(response.text)
+                    future.result()
 
-    resumption_tokens = xml_data.find_all("resumptionToken")
-    curr_record_count = (num_calls + 1) * 1000
+        pages.put(None)
 
-    # Loop through next set of data (if any).
-    if resumption_tokens:
+    except Exception as exc:
 
-        resumption_token.token = resumption_tokens[0].text
+        if not pages.cancelled.is_set():
 
-        print(f"{curr_record_count} PTH records retrieved ...", file=sys.stderr)
+            pages.put(exc)
 
-        return False if RECORD_LIMIT and curr_record_count >= RECORD_LIMIT else True
+def get_set_specs():
+    """
+    Returns the OAIPMH sets for all the partners and collections in DATA_PULL_LOGIC,
+    or None if there are site-wide categories, which need all of PTH's metadata.
 
-    else:
+    Note: this goes by the categories that do_include_record() actually checks, which
+    includes the ones marked "ignore" (that only affects the results checks).
+    """
 
-        print(f"Finished retrieving PTH records - {curr_record_count} records retrieved ...", file=sys.stderr)
+    plan = get_filter_plan()
 
-        return False
+    if plan.site_wide:
 
-def get_data(num_calls=0, resume=False):
+        site_wide_keys = [ plan.categories[category_num][1] for category_num in plan.site_wide ]
+
+        print(f"PTH site-wide categories {', '.join(site_wide_keys)} can match records in any set, so --harvest_sets is ignored - downloading everything ...", file=sys.stderr)
+
+        return None
+
+    return list(plan.set_specs)
+
+def renumber_files(file_nums):
+    "Renumber the downloaded files, so that file_nums[n] becomes file n."
+
+    if file_nums == sorted(file_nums):
+
+        return
+
+    for file_num in file_nums:
+
+        for suffix in FILE_SUFFIXES:
+
+            if os.path.exists(f"etl/data/pth/pth_{file_num}{suffix}"):
+
+                os.rename(f"etl/data/pth/pth_{file_num}{suffix}", f"etl/data/pth/pth_{file_num}{suffix}.tmp")
+
+    for new_file_num, file_num in enumerate(file_nums):
+
+        for suffix in FILE_SUFFIXES:
+
+            if os.path.exists(f"etl/data/pth/pth_{file_num}{suffix}.tmp"):
+
+                os.rename(f"etl/data/pth/pth_{file_num}{suffix}.tmp", f"etl/data/pth/pth_{new_file_num}{suffix}")
+
+def get_data_pipelined(set_specs=None):
     """
-    Download PTH's metadata.
+    Download PTH's metadata (or just the metadata for the given sets) and extract the
+    relevant records as we go: while the next page is being downloaded (on separate
+    threads), the previous page is saved and filtered. Returns the relevant records.
     """
 
-    continue_ = True
-    while continue_:
+    start_download()
 
-        if not get_data_impl(num_calls=num_calls, resume=resume):
+    max_requests = ETLEnv.instance().get_max_requests()
+    pages = PageQueue(maxsize=2 * max_requests)
 
-            continue_ = False
+    num_workers = ETLEnv.instance().get_num_workers()
+    executor = ProcessPoolExecutor(max_workers=num_workers) if num_workers and num_workers > 1 else None
+
+    # Note: the worker processes are started (i.e., forked) by the first task, so get them
+    # going before starting the downloader thread - forking while another thread may be
+    # holding a lock (e.g., in requests or logging) can leave a worker deadlocked.
+    if executor:
+
+        executor.submit(int).result()
+
+    downloader = threading.Thread(target=download_all_pages, kwargs={ "pages": pages, "set_specs": set_specs }, daemon=True)
+    downloader.start()
+
+    # Pages from a single download arrive in order, so they can be checkpointed as usual.
+    checkpoint = Checkpoint() if set_specs is None else None
+
+    # (set_num, page_num, file_num, extracted records) for each page - or a future
+    # for the extracted records, if using worker processes.
+    results = []
+
+    try:
+
+        file_num = 0
+
+        while True:
+
+            page = pages.get()
+            if page is None:
+
+                break
+
+            if isinstance(page, Exception):
+
+                raise page
+
+            set_num, page_num, content = page
+
+            write_file(file_num=file_num, content=content)
+
+            if checkpoint:
+
+                checkpoint.add_page(file_num=file_num, content=content, token=get_resumption_token(content=content))
+
+            if executor:
+
+                result = executor.submit(extract_data_impl, file_num)
+
+            else:
+
+                result = extract_records(source=io.BytesIO(content))
+
+            results.append((set_num, page_num, file_num, result))
+            file_num += 1
+
+        # Pages from different sets arrive in whatever order they are downloaded, so
+        # merge them (and renumber the files to match) in set order.
+        results.sort(key=lambda result: result[ : 2])
+
+        records = []
+        seen = set()
+
+        for set_num, page_num, file_num, result in results:
+
+            if executor:
+
+                result = result.result()
+
+            if result:
+
+                records += merge_results(results=[ result ], seen=seen)
+
+        renumber_files(file_nums=[ result[2] for result in results ])
+
+    finally:
+
+        pages.cancel()
+
+        if executor:
+
+            executor.shutdown()
+
+    print(f"Finished extracting data, {len(records)} PTH records extracted ...", file=sys.stderr)
+
+    return records
+
+
+class RecordStore():
+    """
+    Local copy of PTH's records, keyed by OAI identifier, along with the date of the
+    last successful harvest. Kept up to date by get_data_incremental(), so only the
+    records that have changed since the last run need to be downloaded.
+    """
+
+    def __init__(self, path=STORE_PATH):
+
+        self.connection = sqlite3.connect(path)
+
+        self.connection.execute("CREATE TABLE IF NOT EXISTS records (identifier TEXT PRIMARY KEY, datestamp TEXT, record TEXT)")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS harvests (name TEXT PRIMARY KEY, value TEXT)")
+
+    def get_last_harvest(self):
+        "Returns the date of the last successful harvest, if any."
+
+        row = self.connection.execute("SELECT value FROM harvests WHERE name = 'last_harvest'").fetchone()
+
+        return row[0] if row else None
+
+    def set_last_harvest(self, date):
+
+        with self.connection:
+
+            self.connection.execute("INSERT OR REPLACE INTO harvests (name, value) VALUES ('last_harvest', ?)", (date, ))
+
+    def add_page(self, content):
+        """
+        Add (or update) the records in a page of OAIPMH xml, and remove any records
+        whose headers say they have been deleted. Returns the number of records
+        (updated, deleted).
+        """
 
-        resume = False
-        num_calls += 1
+        num_updated = 0
+        num_deleted = 0
+
+        with self.connection:
+
+            for element in iter_oaipmh_elements(source=io.BytesIO(content)):
+
+                header = element.find("{*}header")
+                if header is None:
+
+                    continue
+
+                identifier = (header.findtext("{*}identifier") or "").strip()
+                if not identifier:
+
+                    continue
+
+                if header.get("status") == "deleted":
+
+                    self.connection.execute("DELETE FROM records WHERE identifier = ?", (identifier, ))
+                    num_deleted += 1
+
+                    continue
+
+                record = get_oaipmh_element_record(record=element)
+                if not record:
+
+                    continue
+
+                # Note: an updated record keeps its place in the store (see get_records()).
+                self.connection.execute(
+                    "INSERT INTO records (identifier, datestamp, record) VALUES (?, ?, ?) "
+                    "ON CONFLICT(identifier) DO UPDATE SET datestamp = excluded.datestamp, record = excluded.record",
+                    (identifier, (header.findtext("{*}datestamp") or "").strip(), json.dumps(record))
+                )
+                num_updated += 1
+
+        return num_updated, num_deleted
+
+    def get_records(self):
+        "Yields the stored records, in the order they were first harvested."
+
+        for (record, ) in self.connection.execute("SELECT record FROM records ORDER BY rowid"):
+
+            yield json.loads(record)
+
+    def close(self):
+
+        self.connection.close()
+
+def get_data_incremental(store):
+    """
+    Download the PTH records that have been added, changed or deleted since the last
+    harvest (or all of them, if there hasn't been one) and apply them to the store.
+    """
+
+    from_ = store.get_last_harvest()
+
+    url = start_records_url
+    if from_:
+
+        print(f"Retrieving PTH records changed since {from_} ...", file=sys.stderr)
+
+        url += f"&from={from_}"
+
+    harvest_date = None
+    num_updated = 0
+    num_deleted = 0
+
+    while url:
+
+        response = fetch_page(url=url, allow_no_records=bool(from_))
+        if not response:
+
+            print(f"No PTH records have changed since {from_}", file=sys.stderr)
+            break
+
+        if not harvest_date:
+
+            harvest_date = get_response_date(content=response.content)
+
+        page_updated, page_deleted = store.add_page(content=response.content)
+        num_updated += page_updated
+        num_deleted += page_deleted
+
+        token = get_resumption_token(content=response.content)
+        if token:
+
+            print(f"{num_updated} PTH records updated, {num_deleted} deleted ...", file=sys.stderr)
+
+            url = f"{resume_records_url}&resumptionToken={token}"
+
+        else:
+
+            print(f"Finished retrieving PTH records - {num_updated} records updated, {num_deleted} deleted ...", file=sys.stderr)
+
+            url = None
+
+    # Only move the harvest date on once every page has been stored, so an interrupted
+    # harvest is simply repeated next time. Note: 'from' is inclusive and only the day is
+    # kept, so records changed on the day of this harvest will be downloaded again (which
+    # is harmless, since they just replace themselves in the store).
+    if harvest_date:
+
+        store.set_last_harvest(date=harvest_date[ : 10])
+
+def extract_store_data(store):
+    "Returns the relevant records in the store."
+
+    etl_env = ETLEnv.instance()
+
+    records = []
+
+    for record in store.get_records():
+
+        if do_include_record(record=record):
+
+            records.append(record)
+
+            if etl_env.are_tests_running():
+
+                break
+
+    print(f"Finished extracting data, {len(records)} PTH records extracted ...", file=sys.stderr)
+
+    return records
 
 
 def add_filter_match(key_name, key, filter_name, filter_, match):
@@ -537,110 +1153,235 @@ def add_filter_match(key_name, key, filter_name, filter_, match):
 
         filter_["matches"][match] = filter_.get(match, 0) + 1
 
-def find_keyword_match(record, filter_):
+def replay_filter_match(key_name, key, filter_name, match):
+    "Add a filter match logged by do_include_record() to the hit counts."
 
-    title = ''.join(record.get('title', [])).lower()
-    description = ''.join(record.get('description', [])).lower()
+    filter_ = DATA_PULL_LOGIC[key_name][key]["filters"][filter_name] if filter_name else None
 
-    for keyword in filter_.get("values", []):
+    add_filter_match(key_name=key_name, key=key, filter_name=filter_name, filter_=filter_, match=match)
 
-        if keyword in title or keyword in description:
+class RecordText():
+    "Normalized copies of a record's values, computed at most once per record."
 
-            return keyword
+    def __init__(self, record):
 
-def find_filter_match(record, filter_name, filter_):
+        self.record = record
+        self.keyword_text = None
+        self.keywords = {}
+        self.values = {}
+        self.joined_values = {}
 
-    case_sensitive = filter_.get("case-sensitive", False)
-    exact_match = filter_.get("exact-match", False)
-    desired_values = filter_.get("values", [])
+    def has_keyword(self, keyword):
+        "Returns True if the keyword is in the record's title or description."
 
-    values = record.get(filter_name, [])
-    if type(values) is not list:
+        found = self.keywords.get(keyword)
+        if found is None:
 
-        values = [ values ]
+            if self.keyword_text is None:
 
-    for desired_value in desired_values:
+                # Note: the separator never appears in a keyword, so no keyword can match across it.
+                title = ''.join(self.record.get('title', [])).lower()
+                description = ''.join(self.record.get('description', [])).lower()
 
-        desired_value_copy = desired_value if case_sensitive else desired_value.lower()
+                self.keyword_text = title + '\0' + description
 
-        if exact_match:
+            found = keyword in self.keyword_text
+            self.keywords[keyword] = found
 
-            if desired_value_copy in values:
+        return found
 
-                return desired_value
+    def get_values(self, filter_name):
 
-        else:
+        values = self.values.get(filter_name)
+        if values is None:
 
-            for value in values:
+            values = self.record.get(filter_name, [])
+            if type(values) is not list:
 
-                if case_sensitive:
+                values = [ values ]
 
-                    if desired_value_copy in value:
+            self.values[filter_name] = values
 
-                        return desired_value
+        return values
 
-                else:
+    def get_joined_values(self, filter_name, case_sensitive):
+        """
+        Returns the record's values for the filter, joined with a separator that never
+        appears in a filter value (so a substring test against the joined values is the
+        same as testing each value separately).
+        """
+
+        key = (filter_name, case_sensitive)
+
+        joined = self.joined_values.get(key)
+        if joined is None:
 
-                    if desired_value_copy in value.lower():
+            joined = '\0'.join(self.get_values(filter_name=filter_name))
+            if not case_sensitive:
 
-                        return desired_value
+                joined = joined.lower()
 
-def do_include_record(record):
+            self.joined_values[key] = joined
+
+        return joined
+
+
+class FilterPlan():
     """
-    Returns True if the record should be added, based on the filters.
+    DATA_PULL_LOGIC compiled into a form that is quick to evaluate for every record:
+
+    - categories are looked up by setSpec, rather than checking every category,
+    - the text each filter looks at is normalized once per record (see RecordText),
+    - each keyword is checked at most once per record, even if several filters use it.
+
+    The include decisions and filter hit counts are the same as walking DATA_PULL_LOGIC
+    for each record.
     """
 
-    class IncludeVote():
+    def __init__(self, data_pull_logic):
 
-        def __init__(self, key_name, key, filter_name=None, filter_=None, match=None, filter_includes=True, include_vote_value=True):
+        # Categories, in DATA_PULL_LOGIC order: (key_name, key, filters)
+        self.categories = []
 
-            self.key_name = key_name
-            self.key = key
-            self.filter_name = filter_name
-            self.filter_ = filter_
-            self.match = match
-            self.filter_includes = filter_includes
-            self.include_vote_value = include_vote_value
+        # Categories that apply to every record (i.e., key_name is None).
+        self.site_wide = []
 
+        # setSpec -> categories that apply to records in that set.
+        self.set_specs = {}
 
-    # Loops through all the filters and check each one.
-    for key_name, keys in DATA_PULL_LOGIC.items():
+        for key_name, keys in data_pull_logic.items():
 
-        for key, config in keys.items():
+            for key, config in keys.items():
 
-            # Ignore this filter completely?
-            if config.get("ignore") and False:
+                filters = []
+                for filter_name, filter_ in config.get("filters", {}).items():
 
-                continue
+                    values = filter_.get("values", [])
+                    case_sensitive = filter_.get("case-sensitive", False)
 
-            # First verify record belongs to this category.
-            if key_name and key_name + ":" + key not in record["setSpec"]:
+                    # (desired value, desired value as compared to the record's values)
+                    desired_values = [ (value, value if case_sensitive else value.lower()) for value in values ]
 
-                    continue
+                    filters.append({
+                        "name": filter_name,
+                        "filter": filter_,
+                        "includes": filter_["type"] == "include",
+                        "case_sensitive": case_sensitive,
+                        "exact_match": filter_.get("exact-match", False),
+                        "values": values,
+                        "desired_values": desired_values,
+                    })
 
-            include_votes = []
+                category_num = len(self.categories)
+                self.categories.append((key_name, key, filters))
 
-            # Now apply any filters.
-            filters = config.get("filters", {})
+                if key_name:
 
-            # If the category matches and has no filters, then that is a vote to include the record.
-            if not filters:
+                    self.set_specs.setdefault(key_name + ":" + key, []).append(category_num)
 
-                include_votes.append(IncludeVote(key_name=key_name, key=key, filter_includes=True, include_vote_value=True))
+                else:
 
-            else:
+                    self.site_wide.append(category_num)
 
-                for filter_name, filter_ in filters.items():
+    def get_category_nums(self, record):
+        "Returns the categories that apply to the record, in DATA_PULL_LOGIC order."
 
-                    match = None
+        category_nums = None
 
-                    if filter_name == "keywords":
+        for set_spec in record.get("setSpec", []):
 
-                        match = find_keyword_match(record=record, filter_=filter_)
+            set_category_nums = self.set_specs.get(set_spec)
+            if set_category_nums:
 
-                    else:
+                if category_nums is None:
+
+                    category_nums = set(self.site_wide)
+
+                category_nums.update(set_category_nums)
+
+        # Most records do not belong to any of the sets we are interested in.
+        if category_nums is None:
+
+            return self.site_wide
+
+        return sorted(category_nums)
+
+    def could_include(self, set_specs):
+        "Returns True if a record in the given sets could be included (i.e., if any categories apply to it)."
+
+        if self.site_wide:
+
+            return True
 
-                        match = find_filter_match(record=record, filter_name=filter_name, filter_=filter_)
+        for set_spec in set_specs:
+
+            if set_spec in self.set_specs:
+
+                return True
+
+        return False
+
+    def find_match(self, record_text, filter_):
+        "Returns the first of the filter's values that matches the record, if any."
+
+        if filter_["name"] == "keywords":
+
+            for keyword in filter_["values"]:
+
+                if record_text.has_keyword(keyword=keyword):
+
+                    return keyword
+
+            return None
+
+        if filter_["exact_match"]:
+
+            values = record_text.get_values(filter_name=filter_["name"])
+
+            for desired_value, desired_value_copy in filter_["desired_values"]:
+
+                if desired_value_copy in values:
+
+                    return desired_value
+
+            return None
+
+        if not record_text.get_values(filter_name=filter_["name"]):
+
+            return None
+
+        joined_values = record_text.get_joined_values(filter_name=filter_["name"], case_sensitive=filter_["case_sensitive"])
+
+        for desired_value, desired_value_copy in filter_["desired_values"]:
+
+            if desired_value_copy in joined_values:
+
+                return desired_value
+
+        return None
+
+    def do_include_record(self, record, match_log=None):
+        "See do_include_record()."
+
+        record_text = RecordText(record=record)
+
+        for category_num in self.get_category_nums(record=record):
+
+            key_name, key, filters = self.categories[category_num]
+
+            # Each vote is (filter, match, include vote value).
+            include_votes = []
+
+            # If the category matches and has no filters, then that is a vote to include the record.
+            if not filters:
+
+                include_votes.append((None, None, True))
+
+            else:
+
+                for filter_ in filters:
+
+                    match = self.find_match(record_text=record_text, filter_=filter_)
 
                     # - For a filter that tries to exclude records:
                     #     - if matched, then add a False include vote.
@@ -650,38 +1391,66 @@ def do_include_record(record):
                     #     - if matched, then add a True include vote.
                     #     - if not matched, then add a False include vote.
 
-                    filter_includes = filter_["type"] == "include"
-                    include_vote_value = filter_includes if match else not filter_includes
+                    include_vote_value = filter_["includes"] if match else not filter_["includes"]
+
+                    include_votes.append((filter_, match, include_vote_value))
 
-                    include_votes.append(IncludeVote(key_name=key_name, key=key, filter_name=filter_name, filter_=filter_, match=match, filter_includes=filter_includes, include_vote_value=include_vote_value))
+            # If any of the include votes were False, then this category does not indicate
+            # the record should be included.
+            category_matches = all(vote[2] for vote in include_votes)
 
-            # If nothing in this category matched, or any of the include votes were False,
-            # then this category does not indicate the record should be included.
-            category_matches = len(include_votes) > 0
-            for vote in include_votes:
+            # Now record which filter caused the record to be included or excluded (only
+            # the first one is counted for each category).
+            for filter_, match, include_vote_value in include_votes:
 
-                if not vote.include_vote_value:
+                filter_includes = filter_["includes"] if filter_ else True
 
-                    category_matches = False
+                if category_matches == filter_includes:
 
-            # Now record which filters caused the record to be included or excluded.
-            category_set = set()
-            for vote in include_votes:
+                    filter_name = filter_["name"] if filter_ else None
 
-                if (category_matches and vote.filter_includes) or (not category_matches and not vote.filter_includes):
+                    if match_log is not None:
 
-                    if vote.key_name not in category_set:
+                        match_log.append((key_name, key, filter_name, match))
+
+                    else:
 
-                        category_set.add(vote.key_name)
+                        add_filter_match(key_name=key_name, key=key, filter_name=filter_name, filter_=filter_["filter"] if filter_ else None, match=match)
 
-                        add_filter_match(key_name=vote.key_name, key=vote.key, filter_name=vote.filter_name, filter_=vote.filter_, match=vote.match)
+                    break
 
             if category_matches:
 
                 return True
 
-    # None of the categories indicated the record should be included.
-    return False
+        # None of the categories indicated the record should be included.
+        return False
+
+
+# The compiled DATA_PULL_LOGIC (see get_filter_plan()).
+filter_plan = None
+
+def get_filter_plan():
+    "Returns DATA_PULL_LOGIC compiled into a FilterPlan."
+
+    global filter_plan
+
+    if not filter_plan:
+
+        filter_plan = FilterPlan(data_pull_logic=DATA_PULL_LOGIC)
+
+    return filter_plan
+
+def do_include_record(record, match_log=None):
+    """
+    Returns True if the record should be added, based on the filters.
+
+    If match_log is given, filter matches are appended to it as
+    (key_name, key, filter_name, match) tuples instead of being added to the
+    hit counts (see replay_filter_match()).
+    """
+
+    return get_filter_plan().do_include_record(record=record, match_log=match_log)
 
 def check_filter_results(key_name, key, config):
     "Output error info if results for this filter are not what was expected."
@@ -756,8 +1525,8 @@ def check_results():
 
                 check_filter_results(key_name=key_name, key=key, config=config)
 
-def read_file(file_num):
-    "Returns the contents of the current file."
+def open_file(file_num):
+    "Returns a binary file object for the given file, for streaming its contents."
 
     file_path = f"etl/data/pth/pth_{file_num}.xml"
 
@@ -765,10 +1534,6 @@ def read_file(file_num):
 
         return None
 
-    with open(file_path, "r") as input:
-
-        data = input.read()
-
     # if testing, use test data?
     etl_env = ETLEnv.instance()
     if etl_env.are_tests_running():
@@ -777,11 +1542,72 @@ def read_file(file_num):
 
         data, format_ = try_to_read_test_data()
 
-    return data
+        return io.BytesIO(data.encode("utf-8"))
+
+    return open(file_path, "rb")
+
+def get_record_id(record):
+    "Returns the record's OAI identifier (the one in its header), if any."
+
+    identifiers = record.get("identifier")
+
+    return identifiers[0] if identifiers else None
 
-def extract_data_impl(file_num=0):
+def get_element_record_id(element):
+    "Same as get_record_id(), but for a record's lxml element (so the record doesn't need to be converted first)."
+
+    identifier = element.find("{*}header/{*}identifier")
+    if identifier is None:
+
+        return None
+
+    return ''.join(identifier.itertext()).strip() or None
+
+def extract_records(source, seen=None):
     """
-    Extract all relevant PTH records.
+    Returns the relevant records in the given OAIPMH xml source, along with a log of
+    the filter matches for those records, as (identifier, key_name, key, filter_name, match)
+    tuples (see merge_results()). Records whose identifiers are in seen are skipped
+    before they are converted (merge_results() would skip them anyway).
+    """
+
+    etl_env = ETLEnv.instance()
+
+    records = []
+    match_log = []
+
+    # Get relevant records.
+    for element in iter_oaipmh_elements(source=source):
+
+        if seen and get_element_record_id(element=element) in seen:
+
+            continue
+
+        record = get_oaipmh_element_record(record=element)
+
+        record_match_log = []
+
+        include = do_include_record(record=record, match_log=record_match_log)
+
+        if record_match_log:
+
+            identifier = get_record_id(record=record)
+            match_log += [ (identifier, ) + match for match in record_match_log ]
+
+        if include:
+
+            records.append(record)
+
+            if etl_env.are_tests_running():
+
+                break
+
+    return records, match_log
+
+def extract_data_impl(file_num=0, seen=None):
+    """
+    Extract all relevant PTH records from the given file (see extract_records()).
+    Returns None if there is no such file.
     """
 
     etl_env = ETLEnv.instance()
@@ -790,52 +1616,143 @@ def extract_data_impl(file_num=0):
 
         return None
 
-    # Read current file and parse the xml.
-    data = read_file(file_num=file_num)
-    if not data:
+    if not etl_env.are_tests_running() and os.path.exists(f"etl/data/pth/pth_{file_num}.xml.gz"):
+
+        return extract_compressed_file(file_num=file_num, seen=seen)
+
+    # Stream the current file's records rather than parsing the whole file at once.
+    input = open_file(file_num=file_num)
+    if not input:
 
         return None
 
-    xml_data = BeautifulSoup(markup=data, features="lxml-xml", from_encoding="utf-8")
+    with input:
 
-    # Check for search errors.
-    errors = xml_data.find_all("error")
-    if errors:
+        return extract_records(source=input, seen=seen)
 
-        raise Exception(errors[0].text)
+def extract_compressed_file(file_num, seen=None):
+    """
+    Same as extract_data_impl(), but for a compressed file. The file's index is checked
+    first, so only the records that could be relevant are parsed - and if there are none,
+    the file isn't even decompressed.
+    """
+
+    with gzip.open(f"etl/data/pth/pth_{file_num}.idx.json.gz", "rt") as input:
+
+        index = json.load(input)
+
+    plan = get_filter_plan()
+
+    records = index["records"]
+    candidates = [ record for record in records if plan.could_include(set_specs=record["setSpec"]) and not (seen and record["identifier"] in seen) ]
+
+    if not candidates:
+
+        return [], []
+
+    with gzip.open(f"etl/data/pth/pth_{file_num}.xml.gz", "rb") as input:
+
+        content = input.read()
+
+    if len(candidates) < len(records):
+
+        # Keep the page's own opening and closing xml around the candidate records, so
+        # they are still in the right namespaces.
+        start = records[0]["offset"]
+        end = records[-1]["offset"] + records[-1]["length"]
+
+        content = content[ : start] + b"".join(content[ record["offset"] : record["offset"] + record["length"] ] for record in candidates) + content[end : ]
+
+    return extract_records(source=io.BytesIO(content), seen=seen)
+
+def merge_results(results, seen):
+    """
+    Merge (records, match_log) results from extract_records(), in order, adding the
+    filter matches to the hit counts. Records whose identifiers are in seen (i.e.,
+    records that were already in an earlier result, such as records that belong to
+    more than one set) are skipped. Returns the merged records.
+    """
 
     records = []
 
-    # Get relevant records.
-    for record in xml_data.find_all("record"):
+    for result_records, match_log in results:
 
-        record = get_oaipmh_record(record=record)
+        new_identifiers = set()
 
-        if do_include_record(record=record):
+        for identifier, key_name, key, filter_name, match in match_log:
 
-            records.append(record)
+            if identifier is None or identifier not in seen:
 
-            if etl_env.are_tests_running():
+                replay_filter_match(key_name=key_name, key=key, filter_name=filter_name, match=match)
+                new_identifiers.add(identifier)
 
-                break
+        for record in result_records:
+
+            identifier = get_record_id(record=record)
+
+            if identifier is None or identifier not in seen:
+
+                records.append(record)
+                new_identifiers.add(identifier)
+
+        seen |= new_identifiers
 
     return records
 
-    # # Keep going until we have gone through all of PTH's metadata.
-    # return extract_data(records=records, file_num=file_num+1)
+def get_file_nums():
+    "Returns the numbers of all the downloaded PTH files."
+
+    file_nums = []
+
+    while os.path.exists(get_file_path(file_num=len(file_nums))):
+
+        file_nums.append(len(file_nums))
+
+    return file_nums
+
+def extract_data_parallel(num_workers):
+    """
+    Same as extract_data(), but spreads the files across a pool of worker processes.
+    Results are merged in file order, so the records and hit counts are the same as
+    for extract_data().
+    """
+
+    file_nums = get_file_nums()
+    records = []
+    seen = set()
+
+    with ProcessPoolExecutor(max_workers=num_workers) as executor:
+
+        for file_num, result in zip(file_nums, executor.map(extract_data_impl, file_nums)):
+
+            if result:
+
+                records += merge_results(results=[ result ], seen=seen)
+
+            print(f"Extracted data from file {file_num}, {len(records)} PTH records extracted ...", file=sys.stderr)
+
+    print(f"Finished extracting data, {len(records)} PTH records extracted ...", file=sys.stderr)
+
+    return records
 
 def extract_data():
 
+    num_workers = ETLEnv.instance().get_num_workers()
+    if num_workers and num_workers > 1:
+
+        return extract_data_parallel(num_workers=num_workers)
+
     file_num = 0
     records = []
-    tmp = 1
+    seen = set()
+    result = 1
 
-    while tmp is not None:
+    while result is not None:
 
-        tmp = extract_data_impl(file_num=file_num)
-        if tmp:
+        result = extract_data_impl(file_num=file_num, seen=seen)
+        if result:
 
-            records += tmp
+            records += merge_results(results=[ result ], seen=seen)
 
         print(f"Extracted data from file {file_num}, {len(records)} PTH records extracted ...", file=sys.stderr)
 
@@ -912,19 +1829,51 @@ class PTHETLProcess(BaseETLProcess):
 
         etl_env = ETLEnv.instance()
 
+        # Keep a local copy of PTH's records up to date, rather than downloading everything?
+        if etl_env.do_incremental_download():
+
+            store = RecordStore()
+
+            try:
+
+                if not etl_env.use_cache():
+
+                    get_data_incremental(store=store)
+
+                records = extract_store_data(store=store)
+
+            finally:
+
+                store.close()
+
         # Rebuild metadata cached?
-        if not etl_env.use_cache():
+        elif not etl_env.use_cache():
 
+            # Note: an offset of 0 means resume after file 0, so check for None rather than truthiness.
             offset = etl_env.get_call_offset()
             resume = True
-            if not offset:
+            if offset is None:
 
                 offset = 0
                 resume = False
 
-            get_data(num_calls=offset, resume=resume)
+            # Only download the sets we are interested in?
+            set_specs = get_set_specs() if etl_env.do_harvest_sets() and not resume else None
+
+            # Download and extract in one pass?
+            if set_specs is not None or (etl_env.do_pipelined_download() and not resume):
+
+                records = get_data_pipelined(set_specs=set_specs)
+
+            else:
+
+                get_data(num_calls=offset, resume=resume)
+
+                records = extract_data()
+
+        else:
 
-        records = extract_data()
+            records = extract_data()
 
         check_results()
 
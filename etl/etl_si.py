@@ -1,16 +1,16 @@
 #!/usr/bin/env python
 
 import csv
-import json
 import os
 import requests
 import sys
 
 from bs4 import BeautifulSoup
 
+from etl import http_client
 from etl.etl_process import BaseETLProcess
 from etl.setup import ETLEnv
-from etl.tools import RhizomeField
+from etl.tools import RhizomeField, iter_json_array
 from etl.date_parsers import *
 
 
@@ -31,6 +31,13 @@ etl_env = ETLEnv.instance()
 etl_env.start()
 api_key = etl_env.get_api_key(name="smithsonian")
 
+content_url = "https://api.si.edu/openaccess/api/v1.0/content/"
+
+# Note: the artworks are SAAM objects. EDAN ids are "edanmdm-" plus the record id, which
+# is the unit code plus the object number (e.g., "edanmdm-nmaahc_2012.36.4ab" in
+# etl/tests/data/si_1.json).
+edan_id_prefix = "edanmdm-saam_"
+
 
 field_map = {
     "id":                                      RhizomeField.ID,
@@ -74,6 +81,34 @@ def get_record(artwork):
     return record
 
 
+def get_image_urls(id_):
+    "Returns the urls of the images of the artwork with the given object number (looked up in EDAN)."
+
+    response = http_client.get(content_url + edan_id_prefix + id_, params={ "api_key": api_key })
+
+    # Note: EDAN doesn't know about every artwork.
+    if response.status_code == 404:
+
+        return []
+
+    if not response.ok:
+
+        raise Exception(f"Error retrieving EDAN content for {id_}, status code: {response.status_code}, reason: {response.reason}")
+
+    content = response.json()["response"].get("content", {})
+    media = content.get("descriptiveNonRepeating", {}).get("online_media", {}).get("media", [])
+
+    urls = []
+
+    for item in media:
+
+        if item.get("type") == "Images" and item.get("content") and item["content"] not in urls:
+
+            urls.append(item["content"])
+
+    return urls
+
+
 class SIETLProcess(BaseETLProcess):
 
     def init_testing(self):
@@ -115,24 +150,25 @@ class SIETLProcess(BaseETLProcess):
 
         data = []
 
-        with open("etl/data/permanent/si/artworks.json", "r") as input:
+        # Ids of the records extracted so far.
+        record_ids = set()
 
-            buffer = input.read()
-            artworks = json.loads(buffer)
+        # Note: the artworks are read one at a time, so only the ones we want are kept in memory.
+        for artwork in iter_json_array(file_path="etl/data/permanent/si/artworks.json"):
 
-            for artwork in artworks:
+            constituentId = artwork["artworkConstituentRelationships"][0]["constituentId"]
 
-                constituentId = artwork["artworkConstituentRelationships"][0]["constituentId"]
+            if constituentId in artists and artwork["objectNumber"] not in record_ids:
 
-                if constituentId in artists:
+                record_ids.add(artwork["objectNumber"])
 
-                    record = get_record(artwork=artwork)
-                    data.append(record)
+                record = get_record(artwork=artwork)
+                data.append(record)
 
 
-                    if len(data) % 25 == 0:
+                if len(data) % 25 == 0:
 
-                        print(f"Extracted {len(data)} records", file=sys.stderr)
+                    print(f"Extracted {len(data)} records", file=sys.stderr)
 
         return data
 
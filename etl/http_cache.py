@@ -0,0 +1,186 @@
+#!/usr/bin/env python
+
+"""
+On-disk cache of http responses for the ETL scripts (see http_client.get()).
+
+Response bodies are stored gzipped and named by their checksum, so identical
+responses are only stored once. An sqlite index maps each request (url plus
+request headers) to its body, along with the response headers needed to
+revalidate it (ETag, Last-Modified). Once the cache grows past its maximum size,
+the least recently used responses are removed.
+"""
+
+import gzip
+import hashlib
+import json
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+
+import requests
+from requests.structures import CaseInsensitiveDict
+
+
+CACHE_DIR = "etl/data/http_cache"
+
+# Maximum total size (in bytes) of the stored response bodies.
+MAX_CACHE_SIZE = 2 * 1024 * 1024 * 1024
+
+# Response headers that are kept with cached responses.
+CACHED_HEADERS = [ "Content-Type", "ETag", "Last-Modified" ]
+
+
+class ResponseCache():
+
+    def __init__(self, cache_dir=CACHE_DIR, max_size=MAX_CACHE_SIZE):
+
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+
+        os.makedirs(os.path.join(cache_dir, "bodies"), exist_ok=True)
+
+        # Note: the cache is shared by all threads, so access to it is serialized.
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(os.path.join(cache_dir, "index.db"), check_same_thread=False)
+
+        self.connection.execute("CREATE TABLE IF NOT EXISTS entries (key TEXT PRIMARY KEY, status INTEGER, headers TEXT, body TEXT, size INTEGER, stored REAL, accessed REAL)")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS entries_accessed ON entries (accessed)")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS entries_body ON entries (body)")
+
+        # Total size of the stored bodies (each body is only counted once, even if several entries share it).
+        row = self.connection.execute("SELECT SUM(size) FROM (SELECT MAX(size) AS size FROM entries GROUP BY body)").fetchone()
+        self.size = row[0] or 0
+
+    @staticmethod
+    def get_key(url, headers=None):
+        "Returns the cache key for a request for the url with the given request headers."
+
+        key = url
+
+        for name, value in sorted((headers or {}).items()):
+
+            key += f"\n{name.lower()}: {value}"
+
+        return hashlib.sha256(key.encode("utf-8")).hexdigest()
+
+    def get_body_path(self, body):
+
+        return os.path.join(self.cache_dir, "bodies", body[ : 2], body + ".gz")
+
+    def get(self, key):
+        """
+        Returns (the cached response, seconds since it was stored or last revalidated)
+        for the given key, or (None, None) if it isn't cached.
+        """
+
+        with self.lock:
+
+            row = self.connection.execute("SELECT status, headers, body, stored FROM entries WHERE key = ?", (key, )).fetchone()
+            if not row:
+
+                return None, None
+
+            status, headers, body, stored = row
+
+            try:
+
+                with gzip.open(self.get_body_path(body=body), "rb") as input:
+
+                    content = input.read()
+
+            except (OSError, EOFError):
+
+                # The body has gone missing (or is damaged), so forget about the entry.
+                with self.connection:
+
+                    self.connection.execute("DELETE FROM entries WHERE key = ?", (key, ))
+
+                return None, None
+
+            with self.connection:
+
+                self.connection.execute("UPDATE entries SET accessed = ? WHERE key = ?", (time.time(), key))
+
+        response = requests.Response()
+        response.status_code = status
+        response.reason = "OK"
+        response.headers = CaseInsensitiveDict(json.loads(headers))
+        response._content = content
+
+        return response, time.time() - stored
+
+    def put(self, key, response):
+        "Store the response under the given key."
+
+        content = response.content
+        body = hashlib.sha256(content).hexdigest()
+        body_path = self.get_body_path(body=body)
+
+        headers = { name: response.headers[name] for name in CACHED_HEADERS if name in response.headers }
+
+        # Write the body to a temporary file first, so a body is never partially written.
+        os.makedirs(os.path.dirname(body_path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(body_path), suffix=".tmp")
+
+        with os.fdopen(fd, "wb") as output:
+
+            output.write(gzip.compress(content))
+
+        size = os.path.getsize(tmp_path)
+
+        with self.lock:
+
+            if os.path.exists(body_path):
+
+                os.remove(tmp_path)
+
+            else:
+
+                os.replace(tmp_path, body_path)
+                self.size += size
+
+            now = time.time()
+
+            with self.connection:
+
+                self.connection.execute("INSERT OR REPLACE INTO entries (key, status, headers, body, size, stored, accessed) VALUES (?, ?, ?, ?, ?, ?, ?)", (key, response.status_code, json.dumps(headers), body, size, now, now))
+
+            if self.size > self.max_size:
+
+                self.evict()
+
+    def touch(self, key):
+        "Mark the response stored under the given key as fresh (i.e., it has just been revalidated)."
+
+        with self.lock:
+
+            with self.connection:
+
+                self.connection.execute("UPDATE entries SET stored = ? WHERE key = ?", (time.time(), key))
+
+    def evict(self):
+        "Remove the least recently used responses until the cache is back under 90% of its maximum size."
+
+        rows = self.connection.execute("SELECT key, body, size FROM entries ORDER BY accessed").fetchall()
+
+        with self.connection:
+
+            for key, body, size in rows:
+
+                if self.size <= self.max_size * 0.9:
+
+                    break
+
+                self.connection.execute("DELETE FROM entries WHERE key = ?", (key, ))
+
+                # Only remove the body once no other entries share it.
+                if not self.connection.execute("SELECT 1 FROM entries WHERE body = ? LIMIT 1", (body, )).fetchone():
+
+                    body_path = self.get_body_path(body=body)
+                    if os.path.exists(body_path):
+
+                        os.remove(body_path)
+
+                    self.size -= size
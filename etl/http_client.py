@@ -0,0 +1,373 @@
+#!/usr/bin/env python
+
+"""
+Shared http client for the ETL scripts: keep-alive sessions pooled per host, gzip
+negotiation, per-host rate limits (which back off when the host struggles), retries
+with exponential backoff (plus jitter) for server errors and timeouts, and an
+on-disk response cache (see http_cache). See HOST_CONFIG for per-host settings.
+"""
+
+import random
+import requests
+import sys
+import threading
+import time
+from urllib.parse import urlsplit
+
+from requests.adapters import HTTPAdapter
+
+from etl.http_cache import ResponseCache
+from etl.setup import ETLEnv
+
+
+# Settings for hosts that aren't in HOST_CONFIG.
+DEFAULT_HOST_CONFIG = {
+
+    # Seconds to wait for the server to respond.
+    "timeout": 60,
+
+    # Number of times to retry a request that fails with a server error or timeout.
+    "max_retries": 3,
+
+    # Seconds to wait before the first retry (doubled for each retry after that, up to max_backoff).
+    "backoff": 1,
+    "max_backoff": 30,
+
+    # Maximum number of keep-alive connections to the host.
+    "pool_size": 10,
+
+    # Maximum number of requests per second to send to the host (if None, there is no limit).
+    "rate_limit": None,
+
+    # Seconds that a cached response is used without checking with the host that it is
+    # still current (if 0, responses from the host are not cached).
+    "cache_ttl": 24 * 60 * 60,
+}
+
+HOST_CONFIG = {
+
+    # PTH's OAI-PMH server can be slow, and is occasionally unavailable for a minute or two.
+    "texashistory.unt.edu": {
+        "timeout": 120,
+        "max_retries": 5,
+        "backoff": 5,
+        "max_backoff": 120,
+
+        # Note: PTH has its own cache of downloaded metadata.
+        "cache_ttl": 0,
+    },
+
+    # Note: DPLA rate limits by api key, and we only use one key.
+    "api.dp.la": {
+        "rate_limit": 5,
+    },
+
+    # Note: Calisphere collections may be queried concurrently (see --max_requests).
+    "solr.calisphere.org": {
+        "rate_limit": 5,
+    },
+
+    # Note: ICAA images are looked up one record at a time, so keep from overwhelming the server.
+    "icaa.mfah.org": {
+        "rate_limit": 5,
+    },
+
+    # Note: the Smithsonian's api keys (from api.data.gov) are limited to 1000 requests an hour.
+    "api.si.edu": {
+        "rate_limit": 1000 / 3600,
+    },
+
+    # The items already loaded into the website change more often.
+    "romogis.frankromo.com": {
+        "cache_ttl": 60 * 60,
+    },
+}
+
+# Responses with these status codes are retried (along with any 5xx response).
+RETRY_STATUS_CODES = [ 429 ]
+
+# Note: requests already asks for gzip, but be explicit about it.
+DEFAULT_HEADERS = {
+    "Accept-Encoding": "gzip, deflate",
+}
+
+# host -> requests.Session
+sessions = {}
+sessions_lock = threading.Lock()
+
+# host -> RateLimiter
+rate_limiters = {}
+rate_limiters_lock = threading.Lock()
+
+# The response cache (see get_cache()).
+cache = None
+cache_lock = threading.Lock()
+
+
+def get_host_config(host):
+    "Returns the settings for the given host (see HOST_CONFIG)."
+
+    config = dict(DEFAULT_HOST_CONFIG)
+    config.update(HOST_CONFIG.get(host, {}))
+
+    return config
+
+def get_session(host):
+    "Returns the keep-alive session for the given host, creating it if necessary."
+
+    with sessions_lock:
+
+        session = sessions.get(host)
+        if not session:
+
+            # Note: keep enough connections open for all the requests we may have in flight at once.
+            pool_size = max(get_host_config(host=host)["pool_size"], ETLEnv.instance().get_max_requests())
+
+            session = requests.Session()
+            session.headers.update(DEFAULT_HEADERS)
+
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+
+            sessions[host] = session
+
+    return session
+
+class RateLimiter():
+    """
+    Token bucket that limits requests to rate requests per second on average, allowing
+    bursts of up to burst requests. Shared by all the threads making requests to a host.
+
+    The rate adapts to how the host is coping: it is halved whenever a request fails
+    with a server error or timeout (see back_off()), and gradually raised back up to
+    the configured rate as requests succeed (see recover()).
+    """
+
+    # The rate is never backed off below this fraction of the configured rate.
+    MIN_RATE_FRACTION = 1 / 16
+
+    # Fraction of the configured rate that the rate is raised by for each successful request.
+    RECOVERY_FRACTION = 1 / 10
+
+    def __init__(self, rate, burst=1):
+
+        self.max_rate = rate
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        "Wait until a request can be sent."
+
+        while True:
+
+            with self.lock:
+
+                now = time.monotonic()
+
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+
+                if self.tokens >= 1:
+
+                    self.tokens -= 1
+                    return
+
+                wait = (1 - self.tokens) / self.rate
+
+            time.sleep(wait)
+
+    def back_off(self):
+        "Halve the rate, since the host is struggling."
+
+        with self.lock:
+
+            self.rate = max(self.rate / 2, self.max_rate * self.MIN_RATE_FRACTION)
+
+    def recover(self):
+        "Raise the rate a bit (up to the configured rate), since the host is coping."
+
+        with self.lock:
+
+            self.rate = min(self.rate + self.max_rate * self.RECOVERY_FRACTION, self.max_rate)
+
+def get_rate_limiter(host):
+    "Returns the rate limiter for the given host, or None if requests to the host aren't limited."
+
+    rate = get_host_config(host=host)["rate_limit"]
+    if not rate:
+
+        return None
+
+    with rate_limiters_lock:
+
+        rate_limiter = rate_limiters.get(host)
+        if not rate_limiter:
+
+            rate_limiter = RateLimiter(rate=rate)
+            rate_limiters[host] = rate_limiter
+
+    return rate_limiter
+
+def get_cache():
+    "Returns the response cache, creating it if necessary."
+
+    global cache
+
+    with cache_lock:
+
+        if not cache:
+
+            cache = ResponseCache()
+
+    return cache
+
+def do_retry(response):
+    "Returns True if the request that got the given response should be retried."
+
+    return response.status_code >= 500 or response.status_code in RETRY_STATUS_CODES
+
+def get_backoff(config, num_retries, response=None):
+    "Returns the number of seconds to wait before the given retry."
+
+    # Use the server's Retry-After value, if it gives one (in seconds).
+    retry_after = response.headers.get("Retry-After") if response is not None else None
+    if retry_after and retry_after.isdigit():
+
+        return min(int(retry_after), config["max_backoff"])
+
+    delay = min(config["backoff"] * (2 ** num_retries), config["max_backoff"])
+
+    # Add jitter, so that concurrent requests that failed together don't all retry together.
+    return delay / 2 + random.uniform(0, delay / 2)
+
+def get_with_retries(url, headers, params, timeout, host, config):
+    """
+    Does an http GET of the url, retrying server errors and timeouts with exponential
+    backoff (see get()).
+    """
+
+    session = get_session(host=host)
+    rate_limiter = get_rate_limiter(host=host)
+
+    num_retries = 0
+
+    while True:
+
+        response = None
+
+        if rate_limiter:
+
+            rate_limiter.acquire()
+
+        try:
+
+            response = session.get(url, headers=headers, params=params, timeout=timeout or config["timeout"])
+
+            if rate_limiter:
+
+                if do_retry(response=response):
+
+                    rate_limiter.back_off()
+
+                else:
+
+                    rate_limiter.recover()
+
+            if not do_retry(response=response) or num_retries >= config["max_retries"]:
+
+                return response
+
+            reason = f"status code: {response.status_code}, reason: {response.reason}"
+
+        except (requests.ConnectionError, requests.Timeout) as exc:
+
+            if rate_limiter:
+
+                rate_limiter.back_off()
+
+            if num_retries >= config["max_retries"]:
+
+                raise
+
+            reason = f"{type(exc).__name__}: {exc}"
+
+        delay = get_backoff(config=config, num_retries=num_retries, response=response)
+
+        # Note: the query string is left out, since it may contain an api key.
+        print(f"Error retrieving {host}{urlsplit(url).path} ({reason}), retrying in {delay:.1f} seconds ...", file=sys.stderr)
+
+        time.sleep(delay)
+
+        num_retries += 1
+
+def get(url, headers=None, params=None, timeout=None, use_cache=True):
+    """
+    Does an http GET of the url, retrying server errors and timeouts with exponential
+    backoff. Returns the response - which may not be ok, if the retries were used up or
+    the error isn't one that is worth retrying - or raises the exception from the last
+    attempt if it never got a response.
+
+    Successful responses are saved in the response cache. If we are using cached data
+    (i.e., --use_cache=yes), a cached response is returned instead of doing the GET, as
+    long as it is less than cache_ttl seconds old (or the host confirms it hasn't changed).
+    If use_cache is False, the response cache is left out of it altogether (for requests
+    that always need the current response).
+    """
+
+    host = urlsplit(url).netloc
+    config = get_host_config(host=host)
+
+    # The tests mock out requests.get().
+    if ETLEnv.instance().are_tests_running():
+
+        return requests.get(url, headers=headers, params=params, timeout=timeout or config["timeout"])
+
+    if not config["cache_ttl"] or not use_cache:
+
+        return get_with_retries(url=url, headers=headers, params=params, timeout=timeout, host=host, config=config)
+
+    response_cache = get_cache()
+    key = ResponseCache.get_key(url=requests.Request("GET", url, params=params).prepare().url, headers=headers)
+
+    cached_response = None
+    request_headers = headers
+
+    if ETLEnv.instance().use_cache():
+
+        cached_response, age = response_cache.get(key=key)
+        if cached_response:
+
+            cached_response.url = url
+
+            if age < config["cache_ttl"]:
+
+                return cached_response
+
+            # Ask the host to only send the response if it has changed.
+            request_headers = dict(headers or {})
+
+            if cached_response.headers.get("ETag"):
+
+                request_headers["If-None-Match"] = cached_response.headers["ETag"]
+
+            if cached_response.headers.get("Last-Modified"):
+
+                request_headers["If-Modified-Since"] = cached_response.headers["Last-Modified"]
+
+    response = get_with_retries(url=url, headers=request_headers, params=params, timeout=timeout, host=host, config=config)
+
+    if cached_response and response.status_code == 304:
+
+        response_cache.touch(key=key)
+
+        return cached_response
+
+    if response.status_code == 200:
+
+        response_cache.put(key=key, response=response)
+
+    return response
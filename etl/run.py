@@ -48,7 +48,7 @@ def do_usage(msg=None):
 
         print(msg, file=sys.stderr)
 
-    print("Usage: run.py institution1 ... institutionN --format[=csv] --rebuild_previous_items=[yes|no] --use_cache=[yes|no] --resume_download=[offset] --dupes_file=[file_name] --category", file=sys.stderr)
+    print("Usage: run.py institution1 ... institutionN --format[=csv] --rebuild_previous_items=[yes|no] --use_cache=[yes|no] --resume_download=[yes|offset] --dupes_file=[file_name] --category --num_workers=[count] --pipelined_download=[yes|no] --harvest_sets=[yes|no] --max_requests=[count] --incremental_download=[yes|no] --compress_cache=[yes|no] --select_fields=[yes|no] --combine_search_terms=[yes|no] --verify_term_filters=[yes|no] --filter_terms_in_solr=[yes|no]", file=sys.stderr)
 
     raise Exception("Invalid usage")
 
@@ -102,7 +102,8 @@ def run_cmd_line(args):
             pos = arg.find('=')
             offset = arg[ pos + 1 : ]
 
-            setup.ETLEnv.instance().set_call_offset(offset=int(offset))
+            # Note: 'yes' means resume after the last file that was downloaded (-1).
+            setup.ETLEnv.instance().set_call_offset(offset=-1 if offset == "yes" else int(offset))
 
         elif arg.startswith("--dupes_file="):
 
@@ -126,6 +127,116 @@ def run_cmd_line(args):
 
             setup.ETLEnv.instance().set_category(category=category)
 
+        elif arg.startswith("--num_workers="):
+
+            if len(arg) < 15:
+
+                raise Exception(f"Invalid number of workers: {arg}")
+
+            pos = arg.find('=')
+            num_workers = arg[ pos + 1 : ]
+
+            setup.ETLEnv.instance().set_num_workers(num_workers=int(num_workers))
+
+        elif arg.startswith("--pipelined_download="):
+
+            if len(arg) not in [ 23, 24 ]:
+
+                raise Exception(f"Invalid format: {arg}")
+
+            pos = arg.find('=')
+            pipelined_download = arg[ pos + 1 : ]
+
+            setup.ETLEnv.instance().set_pipelined_download(pipelined_download=(pipelined_download == "yes"))
+
+        elif arg.startswith("--harvest_sets="):
+
+            if len(arg) not in [ 17, 18 ]:
+
+                raise Exception(f"Invalid format: {arg}")
+
+            pos = arg.find('=')
+            harvest_sets = arg[ pos + 1 : ]
+
+            setup.ETLEnv.instance().set_harvest_sets(harvest_sets=(harvest_sets == "yes"))
+
+        elif arg.startswith("--max_requests="):
+
+            if len(arg) < 16:
+
+                raise Exception(f"Invalid maximum number of requests: {arg}")
+
+            pos = arg.find('=')
+            max_requests = arg[ pos + 1 : ]
+
+            setup.ETLEnv.instance().set_max_requests(max_requests=int(max_requests))
+
+        elif arg.startswith("--incremental_download="):
+
+            if len(arg) not in [ 25, 26 ]:
+
+                raise Exception(f"Invalid format: {arg}")
+
+            pos = arg.find('=')
+            incremental_download = arg[ pos + 1 : ]
+
+            setup.ETLEnv.instance().set_incremental_download(incremental_download=(incremental_download == "yes"))
+
+        elif arg.startswith("--compress_cache="):
+
+            if len(arg) not in [ 19, 20 ]:
+
+                raise Exception(f"Invalid format: {arg}")
+
+            pos = arg.find('=')
+            compress_cache = arg[ pos + 1 : ]
+
+            setup.ETLEnv.instance().set_compress_cache(compress_cache=(compress_cache == "yes"))
+
+        elif arg.startswith("--select_fields="):
+
+            if len(arg) not in [ 18, 19 ]:
+
+                raise Exception(f"Invalid format: {arg}")
+
+            pos = arg.find('=')
+            select_fields = arg[ pos + 1 : ]
+
+            setup.ETLEnv.instance().set_select_fields(select_fields=(select_fields == "yes"))
+
+        elif arg.startswith("--combine_search_terms="):
+
+            if len(arg) not in [ 25, 26 ]:
+
+                raise Exception(f"Invalid format: {arg}")
+
+            pos = arg.find('=')
+            combine_search_terms = arg[ pos + 1 : ]
+
+            setup.ETLEnv.instance().set_combine_search_terms(combine_search_terms=(combine_search_terms == "yes"))
+
+        elif arg.startswith("--verify_term_filters="):
+
+            if len(arg) not in [ 24, 25 ]:
+
+                raise Exception(f"Invalid format: {arg}")
+
+            pos = arg.find('=')
+            verify_term_filters = arg[ pos + 1 : ]
+
+            setup.ETLEnv.instance().set_verify_term_filters(verify_term_filters=(verify_term_filters == "yes"))
+
+        elif arg.startswith("--filter_terms_in_solr="):
+
+            if len(arg) not in [ 25, 26 ]:
+
+                raise Exception(f"Invalid format: {arg}")
+
+            pos = arg.find('=')
+            filter_terms_in_solr = arg[ pos + 1 : ]
+
+            setup.ETLEnv.instance().set_filter_terms_in_solr(filter_terms_in_solr=(filter_terms_in_solr == "yes"))
+
         else:
 
             if arg not in INST_ETL_MAP:
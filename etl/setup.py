@@ -29,6 +29,16 @@ class ETLEnv(object):
         self.offset = None
         self.dupes_file = None
         self.category = None
+        self.num_workers = None
+        self.pipelined_download = False
+        self.harvest_sets = False
+        self.max_requests = 1
+        self.incremental_download = False
+        self.compress_cache = False
+        self.select_fields = False
+        self.combine_search_terms = False
+        self.verify_term_filters = False
+        self.filter_terms_in_solr = False
 
     @staticmethod
     def instance():
@@ -92,6 +102,96 @@ class ETLEnv(object):
 
         return self.category
 
+    def set_num_workers(self, num_workers):
+        "Sets the number of worker processes to use for CPU-bound work."
+
+        self.num_workers = num_workers
+
+    def get_num_workers(self):
+
+        return self.num_workers
+
+    def set_pipelined_download(self, pipelined_download):
+        "Sets flag indicating if downloaded metadata should be extracted while the download is still running."
+
+        self.pipelined_download = pipelined_download
+
+    def do_pipelined_download(self):
+
+        return self.pipelined_download
+
+    def set_harvest_sets(self, harvest_sets):
+        "Sets flag indicating if only the sets we are interested in should be downloaded (rather than everything)."
+
+        self.harvest_sets = harvest_sets
+
+    def do_harvest_sets(self):
+
+        return self.harvest_sets
+
+    def set_max_requests(self, max_requests):
+        "Sets the maximum number of http requests to have in flight at once."
+
+        self.max_requests = max_requests
+
+    def get_max_requests(self):
+
+        return self.max_requests
+
+    def set_incremental_download(self, incremental_download):
+        "Sets flag indicating if only metadata that has changed since the last download should be downloaded."
+
+        self.incremental_download = incremental_download
+
+    def do_incremental_download(self):
+
+        return self.incremental_download
+
+    def set_compress_cache(self, compress_cache):
+        "Sets flag indicating if downloaded metadata files should be stored compressed (along with an index of their records)."
+
+        self.compress_cache = compress_cache
+
+    def do_compress_cache(self):
+
+        return self.compress_cache
+
+    def set_select_fields(self, select_fields):
+        "Sets flag indicating if only the fields we use should be requested from APIs that support it (rather than full records)."
+
+        self.select_fields = select_fields
+
+    def do_select_fields(self):
+
+        return self.select_fields
+
+    def set_combine_search_terms(self, combine_search_terms):
+        "Sets flag indicating if all of a provider's search terms should be searched for with a single query."
+
+        self.combine_search_terms = combine_search_terms
+
+    def do_combine_search_terms(self):
+
+        return self.combine_search_terms
+
+    def set_verify_term_filters(self, verify_term_filters):
+        "Sets flag indicating if Solr's filtering of Calisphere records by search term should be checked against our own filtering."
+
+        self.verify_term_filters = verify_term_filters
+
+    def do_verify_term_filters(self):
+
+        return self.verify_term_filters
+
+    def set_filter_terms_in_solr(self, filter_terms_in_solr):
+        "Sets flag indicating if Calisphere collections should be filtered by search term in Solr, rather than retrieving all their records."
+
+        self.filter_terms_in_solr = filter_terms_in_solr
+
+    def do_filter_terms_in_solr(self):
+
+        return self.filter_terms_in_solr
+
     def init_testing(self):
         "Set system up for testing."
 
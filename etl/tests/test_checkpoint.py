@@ -0,0 +1,117 @@
+#!/usr/bin/env python
+
+import os
+import tempfile
+import unittest
+from unittest.mock import patch
+
+from etl import etl_pth
+from etl.setup import ETLEnv
+
+
+class TestCheckpoint(unittest.TestCase):
+
+    def setUp(self):
+
+        ETLEnv.instance().set_compress_cache(False)
+
+        # Note: the PTH files are always in etl/data/pth, so work in a scratch directory.
+        self.cwd = os.getcwd()
+        self.tmp_dir = tempfile.TemporaryDirectory()
+
+        os.chdir(self.tmp_dir.name)
+        os.makedirs("etl/data/pth")
+
+    def tearDown(self):
+
+        os.chdir(self.cwd)
+        self.tmp_dir.cleanup()
+
+    def download_pages(self, num_pages):
+        "Write num_pages pages of two records each, and add them to a checkpoint."
+
+        checkpoint = etl_pth.Checkpoint()
+
+        for file_num in range(num_pages):
+
+            content = f"<OAI-PMH><record>{file_num}a</record><record>{file_num}b</record></OAI-PMH>".encode("utf-8")
+
+            etl_pth.write_file(file_num=file_num, content=content)
+            checkpoint.add_page(file_num=file_num, content=content, token=f"token{file_num}")
+
+        return checkpoint
+
+    def test_resume(self):
+
+        self.download_pages(num_pages=3)
+
+        checkpoint = etl_pth.Checkpoint.load()
+
+        self.assertEqual(checkpoint.get_record_count(), 6)
+        self.assertEqual(checkpoint.get_resume_point(), (3, "token2"))
+        self.assertEqual(checkpoint.get_resume_point(file_num=0), (1, "token0"))
+
+    def test_add_page_replaces_later_pages(self):
+
+        checkpoint = self.download_pages(num_pages=3)
+
+        checkpoint.add_page(file_num=1, content=b"<OAI-PMH><record>1</record></OAI-PMH>", token="other")
+
+        checkpoint = etl_pth.Checkpoint.load()
+
+        self.assertEqual(len(checkpoint.pages), 2)
+        self.assertEqual(checkpoint.get_resume_point(), (2, "other"))
+
+    def test_partial_file(self):
+
+        self.download_pages(num_pages=3)
+
+        with open("etl/data/pth/pth_1.xml", "ab") as output:
+
+            output.write(b"<record>")
+
+        # The files from the partial one on are downloaded again.
+        self.assertEqual(etl_pth.Checkpoint.load().get_resume_point(), (1, "token0"))
+
+    def test_checksum_mismatch(self):
+
+        self.download_pages(num_pages=3)
+
+        # Same size, different content.
+        with open("etl/data/pth/pth_2.xml", "r+b") as output:
+
+            output.write(b"<OAI-PMX>")
+
+        self.assertEqual(etl_pth.Checkpoint.load().get_resume_point(), (2, "token1"))
+
+    def test_resume_after_first_file(self):
+        "--resume_download=0 resumes after file 0, rather than starting the download again."
+
+        etl_env = ETLEnv.instance()
+        offset = etl_env.get_call_offset()
+
+        etl_env.set_call_offset(offset=0)
+
+        try:
+
+            with patch.object(ETLEnv, "start"), patch.object(etl_pth, "get_data") as get_data, \
+                 patch.object(etl_pth, "extract_data", return_value=[]), patch.object(etl_pth, "check_results"):
+
+                etl_pth.PTHETLProcess(format="csv").extract()
+
+        finally:
+
+            etl_env.set_call_offset(offset=offset)
+
+        get_data.assert_called_once_with(num_calls=0, resume=True)
+
+    def test_no_checkpoint(self):
+
+        with self.assertRaises(Exception):
+
+            etl_pth.Checkpoint.load()
+
+
+if __name__ == '__main__':    # pragma: no cover
+
+    unittest.main()
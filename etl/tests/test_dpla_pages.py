@@ -0,0 +1,131 @@
+#!/usr/bin/env python
+
+from concurrent.futures import Future
+import random
+import time
+import unittest
+from unittest.mock import patch
+
+from etl.setup import ETLEnv
+
+# Note: etl_dpla reads the DPLA api key when it is imported, which the tests don't need.
+with patch.object(ETLEnv, "start"), patch.object(ETLEnv, "get_api_key", return_value="test"):
+
+    from etl import etl_dpla
+
+
+PAGE_SIZE = 2
+
+# provider -> number of docs
+NUM_DOCS = { "A": 9, "B": 1, "C": 5, "D": 0 }
+
+
+def get_page(provider, page, search_term=None):
+    "Stands in for etl_dpla.get_page(), returning PAGE_SIZE docs per page."
+
+    count = NUM_DOCS[provider]
+    start = (page - 1) * PAGE_SIZE
+
+    docs = [ { "id": f"{provider}-{search_term}-{idx}" } for idx in range(start, min(start + PAGE_SIZE, count)) ]
+
+    return { "count": count, "start": start, "limit": PAGE_SIZE, "docs": docs }
+
+def get_page_slowly(provider, page, search_term=None):
+    "Same as get_page(), but the pages come in out of order."
+
+    time.sleep(random.uniform(0, 0.01))
+
+    return get_page(provider=provider, page=page, search_term=search_term)
+
+
+class MockExecutor():
+    "Runs each request straight away, so the tests can see exactly which pages were requested."
+
+    def submit(self, fn, **kwargs):
+
+        future = Future()
+        future.set_result(fn(**kwargs))
+
+        return future
+
+
+class TestRequestPages(unittest.TestCase):
+
+    def setUp(self):
+
+        self.patches = [
+            patch.object(etl_dpla, "get_page", new=get_page),
+            patch.object(etl_dpla, "extract_record", new=lambda doc: doc["id"]),
+        ]
+
+        for patch_ in self.patches:
+
+            patch_.start()
+
+    def tearDown(self):
+
+        for patch_ in self.patches:
+
+            patch_.stop()
+
+    def get_pending(self, provider_pulls):
+
+        return { provider_pull.provider: sorted(provider_pull.pages) for provider_pull in provider_pulls if provider_pull.pages }
+
+    def test_bounded_lookahead(self):
+
+        provider_pulls = [ etl_dpla.ProviderPull(provider=provider) for provider in [ "A", "B", "C" ] ]
+        executor = MockExecutor()
+
+        # Up to 2 * max_requests pages of the current pull are requested.
+        etl_dpla.request_pages(provider_pulls=provider_pulls, curr_pull=0, executor=executor, max_requests=2)
+
+        self.assertEqual(self.get_pending(provider_pulls), { "A": [ 1, 2, 3, 4 ] })
+
+        # Extracted pages are dropped, and once the current pull has no more pages to request,
+        # the next pulls' pages are requested (up to max_requests of them).
+        for page in range(1, 5):
+
+            provider_pulls[0].get_page(page=page)
+
+        etl_dpla.request_pages(provider_pulls=provider_pulls, curr_pull=0, executor=executor, max_requests=2)
+
+        self.assertEqual(self.get_pending(provider_pulls), { "A": [ 5 ], "B": [ 1 ], "C": [ 1 ] })
+
+        # Moving on to the next pull frees up room for more of the later pulls' pages.
+        provider_pulls[0].get_page(page=5)
+        provider_pulls[1].get_page(page=1)
+
+        etl_dpla.request_pages(provider_pulls=provider_pulls, curr_pull=2, executor=executor, max_requests=2)
+
+        self.assertEqual(self.get_pending(provider_pulls), { "C": [ 1, 2, 3 ] })
+
+    def test_same_as_sequential(self):
+
+        pulls = [ ("A", None), ("B", "x"), ("D", None), ("C", "y"), ("A", "z") ]
+
+        expected = [ etl_dpla.extract_provider_records(provider=provider, search_term=search_term) for provider, search_term in pulls ]
+
+        request_pages = etl_dpla.request_pages
+
+        for max_requests in [ 1, 2, 4 ]:
+
+            def check_request_pages(provider_pulls, curr_pull, executor, max_requests):
+
+                request_pages(provider_pulls=provider_pulls, curr_pull=curr_pull, executor=executor, max_requests=max_requests)
+
+                num_pending = [ len(provider_pull.pages) for provider_pull in provider_pulls ]
+
+                self.assertLessEqual(sum(num_pending), 2 * max_requests)
+                self.assertLessEqual(sum(num_pending[curr_pull + 1 : ]), max_requests)
+
+            with patch.object(etl_dpla, "get_page", new=get_page_slowly), patch.object(etl_dpla, "request_pages", new=check_request_pages):
+
+                data = etl_dpla.extract_records_concurrently(pulls=pulls, max_requests=max_requests)
+
+            self.assertEqual(data, expected, max_requests)
+
+
+if __name__ == '__main__':    # pragma: no cover
+
+    unittest.main()
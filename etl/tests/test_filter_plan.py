@@ -0,0 +1,164 @@
+#!/usr/bin/env python
+
+import copy
+import glob
+import unittest
+
+from etl import etl_pth
+from etl.tools import get_oaipmh_element_record, iter_oaipmh_elements
+
+
+def find_keyword_match(record, filter_):
+    "The keyword matching from before DATA_PULL_LOGIC was compiled into a FilterPlan."
+
+    title = ''.join(record.get('title', [])).lower()
+    description = ''.join(record.get('description', [])).lower()
+
+    for keyword in filter_.get("values", []):
+
+        if keyword in title or keyword in description:
+
+            return keyword
+
+def find_filter_match(record, filter_name, filter_):
+    "The filter matching from before DATA_PULL_LOGIC was compiled into a FilterPlan."
+
+    case_sensitive = filter_.get("case-sensitive", False)
+    exact_match = filter_.get("exact-match", False)
+
+    values = record.get(filter_name, [])
+    if type(values) is not list:
+
+        values = [ values ]
+
+    for desired_value in filter_.get("values", []):
+
+        desired_value_copy = desired_value if case_sensitive else desired_value.lower()
+
+        if exact_match:
+
+            if desired_value_copy in values:
+
+                return desired_value
+
+        else:
+
+            for value in values:
+
+                if desired_value_copy in (value if case_sensitive else value.lower()):
+
+                    return desired_value
+
+def do_include_record(data_pull_logic, record, match_log):
+    """
+    The per-record walk of DATA_PULL_LOGIC from before it was compiled into a FilterPlan,
+    logging filter matches the way FilterPlan.do_include_record() does.
+    """
+
+    for key_name, keys in data_pull_logic.items():
+
+        for key, config in keys.items():
+
+            if key_name and key_name + ":" + key not in record["setSpec"]:
+
+                continue
+
+            include_votes = []
+
+            filters = config.get("filters", {})
+            if not filters:
+
+                include_votes.append((None, True, None, True))
+
+            else:
+
+                for filter_name, filter_ in filters.items():
+
+                    if filter_name == "keywords":
+
+                        match = find_keyword_match(record=record, filter_=filter_)
+
+                    else:
+
+                        match = find_filter_match(record=record, filter_name=filter_name, filter_=filter_)
+
+                    filter_includes = filter_["type"] == "include"
+                    include_vote_value = filter_includes if match else not filter_includes
+
+                    include_votes.append((filter_name, filter_includes, match, include_vote_value))
+
+            category_matches = all(vote[3] for vote in include_votes)
+
+            for filter_name, filter_includes, match, include_vote_value in include_votes:
+
+                if category_matches == filter_includes:
+
+                    match_log.append((key_name, key, filter_name, match))
+                    break
+
+            if category_matches:
+
+                return True
+
+    return False
+
+
+class TestFilterPlan(unittest.TestCase):
+
+    def get_records(self):
+        "Returns the records in the PTH test data, plus a copy of each in each of the sets in DATA_PULL_LOGIC."
+
+        set_specs = [ key_name + ":" + key for key_name, keys in etl_pth.DATA_PULL_LOGIC.items() if key_name for key in keys ]
+
+        records = []
+
+        for file_path in sorted(glob.glob("etl/tests/data/pth_*.xml")):
+
+            for element in iter_oaipmh_elements(source=file_path):
+
+                record = get_oaipmh_element_record(record=element)
+                if not record:
+
+                    continue
+
+                records.append(record)
+
+                for set_spec in set_specs:
+
+                    record_copy = copy.deepcopy(record)
+                    record_copy["setSpec"] = [ set_spec ]
+
+                    records.append(record_copy)
+
+        return records
+
+    def test_same_as_per_record_logic(self):
+
+        data_pull_logic = copy.deepcopy(etl_pth.DATA_PULL_LOGIC)
+        plan = etl_pth.FilterPlan(data_pull_logic=data_pull_logic)
+
+        records = self.get_records()
+        self.assertTrue(records)
+
+        num_included = 0
+
+        for record in records:
+
+            expected_log = []
+            expected = do_include_record(data_pull_logic=data_pull_logic, record=record, match_log=expected_log)
+
+            match_log = []
+            included = plan.do_include_record(record=record, match_log=match_log)
+
+            self.assertEqual(included, expected, record.get("identifier"))
+            self.assertEqual(match_log, expected_log, record.get("identifier"))
+
+            num_included += included
+
+        # Make sure the comparison covers both outcomes.
+        self.assertTrue(0 < num_included < len(records))
+
+
+if __name__ == '__main__':    # pragma: no cover
+
+    unittest.main()
@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+
+import random
+import unittest
+from unittest.mock import patch
+
+from bs4 import BeautifulSoup
+
+from etl import tools
+
+
+def remove_html_tags_slow(value):
+    "The html cleanup from before the single-pass version: replace HTML_TAGS, then let BeautifulSoup do the rest."
+
+    for tag, replacement in tools.HTML_TAGS.items():
+
+        value = value.replace(tag, replacement)
+
+    return BeautifulSoup(value, 'html.parser').text
+
+
+# Pieces of text that are put together at random to make html values.
+HTML_PIECES = [
+    "<p>", "</p>", "<br>", "<br/>", "<br />", "<P>", "<em>", "</em>", "<strong>", "</strong>",
+    "<a href=http://x.org/a?b=c&amp;d>", "</a>", "<span class=x>", "</span>", "<div\nclass=y>",
+    "<img src=x/>", "</p >", "<o:p>", "</o:p>", '<a href="q">', "<b", "<p/>", "</>", "<3",
+    "&oacute;", "&amp;", "&ntilde;", "&#233;", "&#x00e9;", "&nbsp;", "&copy", "&bogus;", "&#150;",
+    "& ", "&", "<", "< ", ">", "1 < 2", "a>b",
+    "<!-- c -->", "<!DOCTYPE html>", "<?php ?>", "<![CDATA[x]]>",
+    "<script>x<y</script>", "<SCRIPT>a</SCRIPT>", "<title>t&amp;</title>", "<pre> a </pre>",
+    "\n", "\r\n", "\t", " ", "Arte chicano", "Mexican-American", "texto", "é",
+]
+
+
+class TestRemoveHtmlTags(unittest.TestCase):
+
+    def test_examples(self):
+
+        values = [
+            "",
+            "Plain text description without markup",
+            "<p>El artista chicano&nbsp;presenta <em>obra</em> en M&eacute;xico.</p><p>Segundo p&aacute;rrafo<br/>con l&iacute;nea.</p>",
+            "Tom &amp; Jerry &lt;3",
+            "  \n  ",
+            "<p> </p>",
+            "a &copy b",
+            "a &#150; b",
+            "<!-- comment -->text",
+            "<script>var x = '<p>';</script>",
+        ]
+
+        for value in values:
+
+            self.assertEqual(tools.remove_html_tags_impl(value=value), remove_html_tags_slow(value=value), repr(value))
+
+    def test_random_values(self):
+
+        rand = random.Random(0)
+
+        for _ in range(5000):
+
+            value = "".join(rand.choice(HTML_PIECES) for _ in range(rand.randint(0, 12)))
+
+            self.assertEqual(tools.remove_html_tags_impl(value=value), remove_html_tags_slow(value=value), repr(value))
+
+    def test_fast_path(self):
+        "Values with just simple tags and entities are cleaned without BeautifulSoup."
+
+        value = "<p>Arte <em>chicano</em> en M&eacute;xico &amp; Texas<br/>&#233;</p>"
+
+        with patch.object(tools, "BeautifulSoup", side_effect=AssertionError("BeautifulSoup was used")):
+
+            self.assertEqual(tools.remove_html_tags_impl(value=value), "\nArte chicano en México & Texas\né\n")
+
+    def test_slow_path(self):
+        "Values with anything else in them (e.g., comments) are passed to BeautifulSoup."
+
+        with patch.object(tools, "BeautifulSoup", wraps=BeautifulSoup) as soup:
+
+            self.assertEqual(tools.remove_html_tags_impl(value="a<!-- b -->c"), "ac")
+            self.assertEqual(soup.call_count, 1)
+
+    def test_list(self):
+
+        values = [ "<p>a</p>", "b &amp; c", "<p>a</p>" ]
+
+        self.assertIs(tools.remove_html_tags(values=values), values)
+        self.assertEqual(values, [ "\na\n", "b & c", "\na\n" ])
+
+        self.assertEqual(tools.remove_html_tags(values="x<br>y"), [ "x\ny" ])
+
+
+if __name__ == '__main__':    # pragma: no cover
+
+    unittest.main()
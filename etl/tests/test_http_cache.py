@@ -0,0 +1,206 @@
+#!/usr/bin/env python
+
+import os
+import tempfile
+import unittest
+
+import requests
+
+from etl import http_client
+from etl.http_cache import ResponseCache
+from etl.setup import ETLEnv
+
+
+def make_response(content, status_code=200, headers=None):
+
+    response = requests.Response()
+    response.status_code = status_code
+    response.reason = "OK"
+    response._content = content
+    response.headers.update(headers or {})
+
+    return response
+
+
+class MockSession():
+    "Stands in for a host's keep-alive session, returning the given responses in turn."
+
+    def __init__(self, responses):
+
+        self.responses = list(responses)
+        self.requests = []
+
+    def get(self, url, headers=None, params=None, timeout=None):
+
+        self.requests.append(headers or {})
+
+        return self.responses.pop(0)
+
+
+class TestResponseCache(unittest.TestCase):
+
+    def setUp(self):
+
+        self.tmp_dir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+
+        self.tmp_dir.cleanup()
+
+    def test_put_get(self):
+
+        cache = ResponseCache(cache_dir=self.tmp_dir.name)
+        key = ResponseCache.get_key(url="https://example.org/items?page=1", headers={ "X-Token": "abc" })
+
+        self.assertEqual(cache.get(key=key), (None, None))
+
+        cache.put(key=key, response=make_response(content=b'{"items": []}', headers={ "ETag": '"1"', "Set-Cookie": "a=b" }))
+
+        response, age = cache.get(key=key)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json(), { "items": [] })
+        self.assertEqual(response.headers.get("ETag"), '"1"')
+        self.assertIsNone(response.headers.get("Set-Cookie"))
+        self.assertLess(age, 60)
+
+        # The request headers are part of the key.
+        other_key = ResponseCache.get_key(url="https://example.org/items?page=1", headers={ "X-Token": "xyz" })
+        self.assertEqual(cache.get(key=other_key), (None, None))
+
+    def test_shared_body(self):
+
+        cache = ResponseCache(cache_dir=self.tmp_dir.name)
+
+        cache.put(key="a", response=make_response(content=b"same"))
+        size = cache.size
+
+        cache.put(key="b", response=make_response(content=b"same"))
+
+        self.assertEqual(cache.size, size)
+        self.assertEqual(cache.get(key="b")[0].content, b"same")
+
+    def test_eviction(self):
+
+        body_size = 10 * 1024
+
+        # Note: random bodies don't compress, so each takes up about body_size.
+        cache = ResponseCache(cache_dir=self.tmp_dir.name, max_size=int(3.5 * body_size))
+
+        for key in [ "a", "b", "c" ]:
+
+            cache.put(key=key, response=make_response(content=os.urandom(body_size)))
+
+        # Use "a", so "b" is now the least recently used.
+        self.assertIsNotNone(cache.get(key="a")[0])
+
+        cache.put(key="d", response=make_response(content=os.urandom(body_size)))
+
+        self.assertEqual(cache.get(key="b"), (None, None))
+
+        for key in [ "a", "c", "d" ]:
+
+            self.assertIsNotNone(cache.get(key=key)[0], key)
+
+        self.assertLessEqual(cache.size, cache.max_size)
+
+        # The evicted body has been removed as well.
+        num_bodies = sum(len(file_names) for dir_path, dir_names, file_names in os.walk(os.path.join(self.tmp_dir.name, "bodies")))
+        self.assertEqual(num_bodies, 3)
+
+    def test_reopen(self):
+
+        cache = ResponseCache(cache_dir=self.tmp_dir.name)
+        cache.put(key="a", response=make_response(content=b"abc"))
+
+        cache = ResponseCache(cache_dir=self.tmp_dir.name)
+
+        self.assertEqual(cache.get(key="a")[0].content, b"abc")
+        self.assertGreater(cache.size, 0)
+
+
+class TestRevalidation(unittest.TestCase):
+
+    host = "cache-test.example.org"
+    url = f"https://{host}/items"
+
+    def setUp(self):
+
+        self.tmp_dir = tempfile.TemporaryDirectory()
+
+        etl_env = ETLEnv.instance()
+        self.settings = (etl_env.running_tests, etl_env.use_cache())
+
+        etl_env.running_tests = False
+        etl_env.set_use_cache(use_cached_metadata=True)
+
+        self.cache = http_client.cache
+        http_client.cache = ResponseCache(cache_dir=self.tmp_dir.name)
+
+        http_client.HOST_CONFIG[self.host] = { "cache_ttl": 60 }
+
+    def tearDown(self):
+
+        etl_env = ETLEnv.instance()
+        etl_env.running_tests, use_cache = self.settings
+        etl_env.set_use_cache(use_cached_metadata=use_cache)
+
+        http_client.cache = self.cache
+        del http_client.HOST_CONFIG[self.host]
+        http_client.sessions.pop(self.host, None)
+
+        self.tmp_dir.cleanup()
+
+    def expire(self):
+        "Make the cached response older than the host's cache_ttl."
+
+        with http_client.cache.connection:
+
+            http_client.cache.connection.execute("UPDATE entries SET stored = stored - 3600")
+
+    def test_revalidation(self):
+
+        session = MockSession(responses=[
+            make_response(content=b"v1", headers={ "ETag": '"1"', "Last-Modified": "Mon, 01 Jan 2024 00:00:00 GMT" }),
+            make_response(content=b"", status_code=304),
+            make_response(content=b"v2", headers={ "ETag": '"2"' }),
+        ])
+        http_client.sessions[self.host] = session
+
+        self.assertEqual(http_client.get(url=self.url).content, b"v1")
+
+        # Fresh, so the host isn't asked.
+        self.assertEqual(http_client.get(url=self.url).content, b"v1")
+        self.assertEqual(len(session.requests), 1)
+
+        # Stale, so the host is asked if it has changed - it hasn't.
+        self.expire()
+
+        self.assertEqual(http_client.get(url=self.url).content, b"v1")
+        self.assertEqual(len(session.requests), 2)
+        self.assertEqual(session.requests[1].get("If-None-Match"), '"1"')
+        self.assertEqual(session.requests[1].get("If-Modified-Since"), "Mon, 01 Jan 2024 00:00:00 GMT")
+
+        # The 304 made the cached response fresh again.
+        self.assertEqual(http_client.get(url=self.url).content, b"v1")
+        self.assertEqual(len(session.requests), 2)
+
+        # Stale again, and this time it has changed.
+        self.expire()
+
+        self.assertEqual(http_client.get(url=self.url).content, b"v2")
+        self.assertEqual(http_client.get(url=self.url).content, b"v2")
+        self.assertEqual(len(session.requests), 3)
+
+    def test_no_cache(self):
+
+        session = MockSession(responses=[ make_response(content=b"v1"), make_response(content=b"v2") ])
+        http_client.sessions[self.host] = session
+
+        self.assertEqual(http_client.get(url=self.url).content, b"v1")
+        self.assertEqual(http_client.get(url=self.url, use_cache=False).content, b"v2")
+
+
+if __name__ == '__main__':    # pragma: no cover
+
+    unittest.main()
@@ -0,0 +1,131 @@
+#!/usr/bin/env python
+
+import json
+import os
+import re
+import tempfile
+import unittest
+from unittest.mock import patch
+
+import requests
+
+from etl import etl_icaa, http_client
+
+
+class MockICAA():
+    "Stands in for ICAA's items API, returning num_items items for every keyword."
+
+    def __init__(self, num_items):
+
+        self.num_items = num_items
+        self.pages = []
+
+    def __call__(self, url, **kwargs):
+
+        page = int(re.search(r"[?&]page=(\d+)", url).group(1))
+        keyword = re.search(r"[?&]fulltext_search=([^&]+)", url).group(1)
+
+        self.pages.append((keyword, page))
+
+        start = (page - 1) * etl_icaa.per_page
+        items = [ { "o:id": idx, "keyword": keyword } for idx in range(start, min(start + etl_icaa.per_page, self.num_items)) ]
+
+        response = requests.Response()
+        response.status_code = 200
+        response._content = json.dumps(items).encode("utf-8")
+
+        return response
+
+
+class TestItemsCheckpoint(unittest.TestCase):
+
+    def setUp(self):
+
+        # Note: the ICAA files are always in etl/data/icaa, so work in a scratch directory.
+        self.cwd = os.getcwd()
+        self.tmp_dir = tempfile.TemporaryDirectory()
+
+        os.chdir(self.tmp_dir.name)
+
+        self.icaa = MockICAA(num_items=5)
+
+        self.patches = [
+            patch.object(http_client, "get", new=self.icaa),
+            patch.object(etl_icaa, "per_page", new=2),
+        ]
+
+        for patch_ in self.patches:
+
+            patch_.start()
+
+    def tearDown(self):
+
+        for patch_ in self.patches:
+
+            patch_.stop()
+
+        os.chdir(self.cwd)
+        self.tmp_dir.cleanup()
+
+    def get_items(self, checkpoint, keyword="chicano", num_pages=None):
+        "Returns the ids of the keyword's items, stopping after num_pages pages (as if the extraction was interrupted)."
+
+        ids = []
+
+        for page, items in enumerate(etl_icaa.get_keyword_items(keyword=keyword, checkpoint=checkpoint), start=1):
+
+            ids += [ item["o:id"] for item in items ]
+
+            if page == num_pages:
+
+                break
+
+        return ids
+
+    def test_resume(self):
+
+        self.assertEqual(self.get_items(checkpoint=etl_icaa.ItemsCheckpoint.start(), num_pages=2), [ 0, 1, 2, 3 ])
+
+        checkpoint = etl_icaa.ItemsCheckpoint.load()
+        self.icaa.pages = []
+
+        self.assertEqual(checkpoint.keywords, { "chicano": 2 })
+
+        # Only the page that wasn't downloaded yet is requested.
+        self.assertEqual(self.get_items(checkpoint=checkpoint), [ 0, 1, 2, 3, 4 ])
+        self.assertEqual(self.icaa.pages, [ ("chicano", 3) ])
+
+        # The next keyword starts from the beginning.
+        self.assertEqual(self.get_items(checkpoint=checkpoint, keyword="border"), [ 0, 1, 2, 3, 4 ])
+        self.assertEqual(etl_icaa.ItemsCheckpoint.load().keywords, { "chicano": 3, "border": 3 })
+
+    def test_missing_page(self):
+
+        self.get_items(checkpoint=etl_icaa.ItemsCheckpoint.start())
+
+        os.remove(etl_icaa.ItemsCheckpoint.get_page_path(keyword="chicano", page=2))
+        self.icaa.pages = []
+
+        # A page that is in the checkpoint, but not on disk, is downloaded again.
+        self.assertEqual(self.get_items(checkpoint=etl_icaa.ItemsCheckpoint.load()), [ 0, 1, 2, 3, 4 ])
+        self.assertEqual(self.icaa.pages, [ ("chicano", 2) ])
+
+    def test_start_removes_old_pages(self):
+
+        self.get_items(checkpoint=etl_icaa.ItemsCheckpoint.start())
+
+        checkpoint = etl_icaa.ItemsCheckpoint.start()
+
+        self.assertEqual(checkpoint.keywords, {})
+        self.assertEqual(os.listdir(etl_icaa.ITEMS_DIR), [ "checkpoint.json" ])
+
+    def test_no_checkpoint(self):
+
+        with self.assertRaises(Exception):
+
+            etl_icaa.ItemsCheckpoint.load()
+
+
+if __name__ == '__main__':    # pragma: no cover
+
+    unittest.main()
@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+
+import json
+import os
+import random
+import tempfile
+import unittest
+
+from etl.tools import iter_json_array
+
+
+class TestIterJsonArray(unittest.TestCase):
+
+    def setUp(self):
+
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.file_path = os.path.join(self.tmp_dir.name, "array.json")
+
+    def tearDown(self):
+
+        self.tmp_dir.cleanup()
+
+    def write(self, text):
+
+        with open(self.file_path, "w") as output:
+
+            output.write(text)
+
+    def get_random_value(self, rand, depth=0):
+
+        choice = rand.randint(0, 6 if depth < 3 else 3)
+
+        if choice == 0:
+
+            return rand.randint(-10 ** 6, 10 ** 6)
+
+        if choice == 1:
+
+            return rand.uniform(-2500, 2500)
+
+        if choice == 2:
+
+            return "".join(rand.choice('ab ,]}[{"\\\né') for _ in range(rand.randint(0, 20)))
+
+        if choice == 3:
+
+            return rand.choice([ True, False, None ])
+
+        if choice == 4:
+
+            return [ self.get_random_value(rand=rand, depth=depth + 1) for _ in range(rand.randint(0, 4)) ]
+
+        return { f"key{idx}": self.get_random_value(rand=rand, depth=depth + 1) for idx in range(rand.randint(0, 4)) }
+
+    def test_same_as_json_load(self):
+
+        rand = random.Random(0)
+
+        for _ in range(100):
+
+            data = [ self.get_random_value(rand=rand) for _ in range(rand.randint(0, 30)) ]
+            self.write(text=json.dumps(data, indent=rand.choice([ None, 2 ])))
+
+            # Note: small chunks split elements (and numbers) across chunks.
+            for chunk_size in [ 1, 7, 64, 1024 * 1024 ]:
+
+                self.assertEqual(list(iter_json_array(file_path=self.file_path, chunk_size=chunk_size)), data)
+
+    def test_number_split_across_chunks(self):
+
+        self.write(text="[-2500.125, 1e10]")
+
+        for chunk_size in range(1, 12):
+
+            self.assertEqual(list(iter_json_array(file_path=self.file_path, chunk_size=chunk_size)), [ -2500.125, 1e10 ])
+
+    def test_empty(self):
+
+        self.write(text=" [ ] ")
+
+        self.assertEqual(list(iter_json_array(file_path=self.file_path)), [])
+
+    def test_not_an_array(self):
+
+        self.write(text='{"a": 1}')
+
+        with self.assertRaises(Exception):
+
+            list(iter_json_array(file_path=self.file_path))
+
+    def test_truncated(self):
+
+        self.write(text='[{"a": 1}, {"b": 2')
+
+        with self.assertRaises(Exception):
+
+            list(iter_json_array(file_path=self.file_path, chunk_size=4))
+
+
+if __name__ == '__main__':    # pragma: no cover
+
+    unittest.main()
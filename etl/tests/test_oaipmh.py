@@ -0,0 +1,53 @@
+#!/usr/bin/env python
+
+import io
+import unittest
+
+from bs4 import BeautifulSoup
+
+from etl.tools import get_oaipmh_record, iter_oaipmh_records
+
+
+def get_xml(titles):
+    "Returns an OAIPMH page with a record for each of the given titles."
+
+    records = b"".join(
+        b'<record><header><identifier>oai:example.org:' + str(idx).encode("utf-8") + b'</identifier></header>'
+        b'<metadata><oai_dc:dc xmlns:oai_dc="http://www.openarchives.org/OAI/2.0/oai_dc/" xmlns:dc="http://purl.org/dc/elements/1.1/">'
+        b'<dc:title>' + title + b'</dc:title><dc:subject>Chicano art</dc:subject></oai_dc:dc></metadata></record>'
+        for idx, title in enumerate(titles)
+    )
+
+    return b'<?xml version="1.0" encoding="UTF-8"?><OAI-PMH xmlns="http://www.openarchives.org/OAI/2.0/"><ListRecords>' + records + b'</ListRecords></OAI-PMH>'
+
+
+class TestOAIPMHRecords(unittest.TestCase):
+
+    def check(self, xml):
+        "Check that the incremental parser returns the same records as BeautifulSoup's lxml-xml parser."
+
+        expected = [ get_oaipmh_record(record=record) for record in BeautifulSoup(xml, "lxml-xml").find_all("record") ]
+
+        records = list(iter_oaipmh_records(source=io.BytesIO(xml)))
+
+        self.assertEqual(records, expected)
+
+        return records
+
+    def test_records(self):
+
+        records = self.check(xml=get_xml(titles=[ b"Arte chicano", b"Tom &amp; Jerry", "México".encode("utf-8") ]))
+
+        self.assertEqual([ record["title"] for record in records ], [ [ "Arte chicano" ], [ "Tom & Jerry" ], [ "México" ] ])
+
+    def test_invalid_character(self):
+
+        # Note: control characters aren't allowed in xml 1.0, but turn up in OAIPMH feeds.
+        records = self.check(xml=get_xml(titles=[ b"Arte\x0b chicano", b"Segundo" ]))
+
+        self.assertEqual([ record["title"] for record in records ], [ [ "Arte chicano" ], [ "Segundo" ] ])
+
+
+if __name__ == '__main__':    # pragma: no cover
+
+    unittest.main()
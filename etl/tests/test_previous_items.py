@@ -0,0 +1,269 @@
+#!/usr/bin/env python
+
+import json
+import os
+import tempfile
+import unittest
+from unittest.mock import patch
+
+import requests
+
+from etl import http_client, tools
+from etl.setup import ETLEnv
+
+
+class MockOmeka():
+    "Stands in for the Rhizomes website's Omeka items API."
+
+    def __init__(self):
+
+        # Omeka item id -> item
+        self.items = {}
+        self.requests = []
+
+        # Number of items the website says it has (if None, the actual number).
+        self.total = None
+
+    def add_item(self, item_id, created, modified=None, url=None):
+
+        def get_time(seconds):
+
+            return { "@value": f"2024-01-01T{seconds // 3600:02d}:{seconds // 60 % 60:02d}:{seconds % 60:02d}+00:00" }
+
+        self.items[item_id] = {
+            "o:id": item_id,
+            "o:created": get_time(created),
+            "o:modified": get_time(modified) if modified is not None else None,
+            "foaf:weblog": [ { "@id": url or f"https://example.org/{item_id}" } ],
+        }
+
+    def get_urls(self):
+
+        return { item["foaf:weblog"][0]["@id"] for item in self.items.values() }
+
+    def __call__(self, url, params=None, use_cache=True, **kwargs):
+
+        self.requests.append((params["sort_by"], use_cache))
+
+        def get_sort_key(item):
+
+            if params["sort_by"] == "id":
+
+                return item["o:id"]
+
+            # Note: items that have never been modified come last, as with MySQL.
+            value = item["o:" + params["sort_by"]]
+
+            return value["@value"] if value else ""
+
+        items = sorted(self.items.values(), key=get_sort_key, reverse=params["sort_order"] == "desc")
+
+        per_page = params["per_page"]
+        page = items[ (params["page"] - 1) * per_page : params["page"] * per_page ]
+
+        response = requests.Response()
+        response.status_code = 200
+        response._content = json.dumps(page).encode("utf-8")
+        response.headers["Omeka-S-Total-Results"] = str(self.total or len(items))
+
+        return response
+
+
+class TestPreviousItems(unittest.TestCase):
+
+    def setUp(self):
+
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.file_path = os.path.join(self.tmp_dir.name, "previous_items.json")
+
+        self.max_requests = ETLEnv.instance().get_max_requests()
+        ETLEnv.instance().set_max_requests(max_requests=4)
+
+        self.omeka = MockOmeka()
+
+        for item_id in range(1, 96):
+
+            self.omeka.add_item(item_id=item_id, created=item_id)
+
+        self.patches = [
+            patch.object(http_client, "get", new=self.omeka),
+            patch.object(tools, "omeka_items_per_page", new=10),
+        ]
+
+        for patch_ in self.patches:
+
+            patch_.start()
+
+    def tearDown(self):
+
+        for patch_ in self.patches:
+
+            patch_.stop()
+
+        ETLEnv.instance().set_max_requests(max_requests=self.max_requests)
+
+        self.tmp_dir.cleanup()
+
+    def sync(self):
+        "Same as get_previous_item_ids(), using the test's snapshot file."
+
+        previous_items = tools.PreviousItems(file_path=self.file_path)
+
+        if not previous_items.synced or not previous_items.refresh():
+
+            previous_items.build()
+
+        previous_items.save()
+
+        return previous_items.get_urls()
+
+    def test_build(self):
+
+        self.assertEqual(self.sync(), self.omeka.get_urls())
+
+        # 10 pages, all retrieved by id.
+        self.assertEqual(len(self.omeka.requests), 10)
+        self.assertEqual({ sort_by for sort_by, use_cache in self.omeka.requests }, { "id" })
+
+    def test_build_empty_page(self):
+
+        # The website says it has more items than it has (e.g., some were just deleted).
+        self.omeka.total = 200
+
+        previous_items = tools.PreviousItems(file_path=None)
+        previous_items.build()
+
+        self.assertEqual(previous_items.get_urls(), self.omeka.get_urls())
+
+    def test_build_no_items(self):
+
+        self.omeka.items = {}
+
+        previous_items = tools.PreviousItems(file_path=None)
+        previous_items.build()
+
+        self.assertEqual(previous_items.get_urls(), set())
+
+    def test_build_bad_page(self):
+
+        self.sync()
+
+        # An html error page (or truncated body) isn't the end of the items, so the snapshot is kept as it was.
+        def get(url, params=None, use_cache=True, **kwargs):
+
+            response = self.omeka(url=url, params=params, use_cache=use_cache)
+
+            if params["page"] == 2:
+
+                response._content = b"<html><body>Service Unavailable</body></html>"
+
+            return response
+
+        previous_items = tools.PreviousItems(file_path=self.file_path)
+
+        with patch.object(http_client, "get", new=get):
+
+            with self.assertRaises(Exception):
+
+                previous_items.build()
+
+        self.assertEqual(tools.PreviousItems(file_path=self.file_path).get_urls(), self.omeka.get_urls())
+
+    def test_refresh(self):
+
+        self.sync()
+        self.omeka.requests = []
+
+        # Nothing has changed, so only the first page of each of the newest created / modified items is retrieved.
+        self.assertEqual(self.sync(), self.omeka.get_urls())
+        self.assertEqual(self.omeka.requests, [ ("created", False), ("modified", False) ])
+
+        # New and modified items are picked up.
+        self.omeka.add_item(item_id=200, created=200)
+        self.omeka.add_item(item_id=5, created=5, modified=201, url="https://example.org/5/changed")
+        self.omeka.requests = []
+
+        self.assertEqual(self.sync(), self.omeka.get_urls())
+        self.assertEqual(len(self.omeka.requests), 2)
+
+        # An item modified after the last sync, but before the newest new item, is picked up as well.
+        self.omeka.add_item(item_id=300, created=300)
+        self.omeka.add_item(item_id=6, created=6, modified=250, url="https://example.org/6/changed")
+
+        self.assertEqual(self.sync(), self.omeka.get_urls())
+
+    def test_refresh_deleted(self):
+
+        self.sync()
+
+        del self.omeka.items[7]
+        self.omeka.requests = []
+
+        # The snapshot no longer matches the website's item count, so it is built again.
+        self.assertEqual(self.sync(), self.omeka.get_urls())
+        self.assertIn(("id", True), self.omeka.requests)
+
+    def test_refresh_deleted_and_created(self):
+
+        self.sync()
+
+        # The website has the same number of items as before, but the snapshot has the new one as well as the deleted one.
+        del self.omeka.items[8]
+        self.omeka.add_item(item_id=200, created=200)
+        self.omeka.requests = []
+
+        self.assertEqual(self.sync(), self.omeka.get_urls())
+        self.assertIn(("id", True), self.omeka.requests)
+
+    def test_find_urls(self):
+
+        urls = [ "https://example.org/1", "https://example.org/2", "https://example.org/missing" ]
+
+        with patch.object(http_client, "get") as get:
+
+            response = requests.Response()
+            response.status_code = 200
+            response._content = json.dumps([ self.omeka.items[1], self.omeka.items[2] ]).encode("utf-8")
+
+            get.return_value = response
+
+            self.assertEqual(tools.find_previous_item_ids(urls=urls), set(urls[ : 2 ]))
+
+            params = get.call_args.kwargs["params"]
+
+            self.assertEqual(params["property[2][text]"], "https://example.org/missing")
+            self.assertEqual(params["property[2][joiner]"], "or")
+            self.assertFalse(get.call_args.kwargs["use_cache"])
+
+    def test_choose_url_lookup(self):
+
+        # 95 items is 10 pages, so looking up 20 urls (1 request) is quicker, but 200 urls (10 requests) isn't.
+        self.assertTrue(tools.do_find_previous_item_ids(urls=[ "https://example.org/1" ] * 20))
+        self.assertFalse(tools.do_find_previous_item_ids(urls=[ "https://example.org/1" ] * 200))
+
+        # The item count isn't taken from the response cache.
+        self.assertEqual(self.omeka.requests, [ ("id", False), ("id", False) ])
+
+    def test_no_url_lookup_in_tests(self):
+        "The tests' mock responses are numbered, so the url lookup's extra requests would throw them off."
+
+        etl_env = ETLEnv.instance()
+        running_tests = etl_env.running_tests
+
+        etl_env.running_tests = True
+
+        try:
+
+            urls = tools.get_previous_item_ids(urls=[ "https://example.org/1" ])
+
+        finally:
+
+            etl_env.running_tests = running_tests
+
+        self.assertEqual(urls, self.omeka.get_urls())
+        self.assertEqual({ sort_by for sort_by, use_cache in self.omeka.requests }, { "id" })
+
+
+if __name__ == '__main__':    # pragma: no cover
+
+    unittest.main()
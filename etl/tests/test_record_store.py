@@ -0,0 +1,130 @@
+#!/usr/bin/env python
+
+import os
+import tempfile
+import unittest
+from unittest.mock import patch
+
+import requests
+
+from etl import etl_pth, http_client
+
+
+def get_record_xml(identifier, title=None, deleted=False):
+
+    if deleted:
+
+        return f'<record><header status="deleted"><identifier>{identifier}</identifier><datestamp>2024-02-01</datestamp></header></record>'
+
+    return (
+        f'<record><header><identifier>{identifier}</identifier><datestamp>2024-01-01</datestamp></header>'
+        '<metadata><oai_dc:dc xmlns:oai_dc="http://www.openarchives.org/OAI/2.0/oai_dc/" xmlns:dc="http://purl.org/dc/elements/1.1/">'
+        f'<dc:title>{title or identifier}</dc:title></oai_dc:dc></metadata></record>'
+    )
+
+def get_page_xml(response_date, records="", token=None, error=None):
+
+    body = f'<error code="{error}">No records</error>' if error else f'<ListRecords>{records}<resumptionToken>{token or ""}</resumptionToken></ListRecords>'
+
+    return f'<?xml version="1.0" encoding="UTF-8"?><OAI-PMH xmlns="http://www.openarchives.org/OAI/2.0/"><responseDate>{response_date}</responseDate>{body}</OAI-PMH>'.encode("utf-8")
+
+
+class MockPTH():
+    "Stands in for PTH's OAIPMH endpoint, returning the given pages in turn."
+
+    def __init__(self, pages):
+
+        self.pages = pages
+        self.urls = []
+
+    def __call__(self, url, **kwargs):
+
+        self.urls.append(url)
+
+        response = requests.Response()
+        response.status_code = 200
+        response._content = self.pages.pop(0)
+
+        return response
+
+
+class TestRecordStore(unittest.TestCase):
+
+    def setUp(self):
+
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.store = etl_pth.RecordStore(path=os.path.join(self.tmp_dir.name, "pth_store.db"))
+
+    def tearDown(self):
+
+        self.store.close()
+        self.tmp_dir.cleanup()
+
+    def harvest(self, pages):
+
+        pth = MockPTH(pages=pages)
+
+        with patch.object(http_client, "get", new=pth):
+
+            etl_pth.get_data_incremental(store=self.store)
+
+        return pth.urls
+
+    def get_titles(self):
+
+        return [ record["title"][0] for record in self.store.get_records() ]
+
+    def test_full_harvest(self):
+
+        urls = self.harvest(pages=[
+            get_page_xml(response_date="2024-01-05T10:00:00Z", records=get_record_xml("a") + get_record_xml("b"), token="t1"),
+            get_page_xml(response_date="2024-01-05T10:01:00Z", records=get_record_xml("c")),
+        ])
+
+        self.assertNotIn("from=", urls[0])
+        self.assertIn("resumptionToken=t1", urls[1])
+
+        self.assertEqual(self.get_titles(), [ "a", "b", "c" ])
+        self.assertEqual(self.store.get_last_harvest(), "2024-01-05")
+
+    def test_incremental_harvest(self):
+
+        self.harvest(pages=[ get_page_xml(response_date="2024-01-05T10:00:00Z", records=get_record_xml("a") + get_record_xml("b") + get_record_xml("c")) ])
+
+        # "b" has changed, "a" has been deleted and "d" is new.
+        urls = self.harvest(pages=[
+            get_page_xml(response_date="2024-02-03T10:00:00Z", records=get_record_xml("b", title="b2") + get_record_xml("a", deleted=True) + get_record_xml("d")),
+        ])
+
+        self.assertIn("from=2024-01-05", urls[0])
+
+        # Note: the changed record keeps its place.
+        self.assertEqual(self.get_titles(), [ "b2", "c", "d" ])
+        self.assertEqual(self.store.get_last_harvest(), "2024-02-03")
+
+    def test_nothing_changed(self):
+
+        self.harvest(pages=[ get_page_xml(response_date="2024-01-05T10:00:00Z", records=get_record_xml("a")) ])
+        self.harvest(pages=[ get_page_xml(response_date="2024-02-03T10:00:00Z", error="noRecordsMatch") ])
+
+        self.assertEqual(self.get_titles(), [ "a" ])
+        self.assertEqual(self.store.get_last_harvest(), "2024-01-05")
+
+    def test_interrupted_harvest(self):
+
+        self.harvest(pages=[ get_page_xml(response_date="2024-01-05T10:00:00Z", records=get_record_xml("a")) ])
+
+        # The second page fails, so the harvest date isn't moved on (and the next harvest repeats this one).
+        with self.assertRaises(Exception):
+
+            self.harvest(pages=[
+                get_page_xml(response_date="2024-02-03T10:00:00Z", records=get_record_xml("b"), token="t1"),
+                get_page_xml(response_date="2024-02-03T10:01:00Z", error="badResumptionToken"),
+            ])
+
+        self.assertEqual(self.store.get_last_harvest(), "2024-01-05")
+
+
+if __name__ == '__main__':    # pragma: no cover
+
+    unittest.main()